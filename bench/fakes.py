@@ -0,0 +1,334 @@
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+import types
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from google.api_core import exceptions as api_exceptions
+from PIL import Image, ImageDraw
+
+
+# -------------------------------
+# ベンチマーク用の偽物（スプレッドシート・Gemini・PDF 配信サーバー）
+# -------------------------------
+PAGES = 20  # ステージの「15 ページ以下は対象外」に掛からないページ数
+VALUE_PAGE = 14  # バリューのページ（統合報告書では表紙・目次の後ろにあることが多い）
+
+COMPANY = "Bench Corp {n:04d}"
+VALUE = (
+    "Our Values: Integrity first, customer focus in every decision, "
+    "respect for colleagues and society, and the courage to take on new challenges. "
+)
+FILLER = "Business review: revenue, operating income and segment results for the fiscal year. "
+
+
+# ============================================================
+#  シート（gspread の Worksheet の代わり）
+# ============================================================
+def _a1_to_index(cell):
+    m = re.match(r"([A-Z]+)(\d+)", cell)
+    col = 0
+    for ch in m.group(1):
+        col = col * 26 + ord(ch) - 64
+    return int(m.group(2)) - 1, col - 1
+
+
+class FakeWorksheet:
+    """row_values・batch_get・batch_update が使う部分だけを持つメモリ上のシート"""
+
+    def __init__(self, header, rows):
+        self.title = "bench"
+        self.id = 0
+        self.values = [list(header)] + [list(r) for r in rows]
+        self.spreadsheet = self
+        self.calls = {"values_get": 0, "batch_get": 0, "batch_update": 0}
+        self.cells_read = 0
+        self._lock = threading.Lock()
+
+    @property
+    def row_count(self):
+        return len(self.values)
+
+    @property
+    def col_count(self):
+        return len(self.values[0])
+
+    def row_values(self, row):
+        with self._lock:
+            self.calls["values_get"] += 1
+            values = list(self.values[row - 1])
+            self.cells_read += len(values)
+            return values
+
+    def batch_get(self, ranges, major_dimension=None):
+        """列全体の範囲（"C1:C" など）だけに対応。major_dimension="COLUMNS" の形で返す"""
+        with self._lock:
+            self.calls["batch_get"] += 1
+            result = []
+            for rng in ranges:
+                start, _ = rng.split(":")
+                r0, c0 = _a1_to_index(start)
+                column = [str(r[c0]) if c0 < len(r) else "" for r in self.values[r0:]]
+                while column and column[-1] == "":
+                    column.pop()
+                self.cells_read += len(column)
+                result.append([column] if column else [])
+            return result
+
+    def batch_update(self, data, **kwargs):
+        with self._lock:
+            self.calls["batch_update"] += 1
+            for item in data:
+                start, end = item["range"].split(":")
+                r0, c0 = _a1_to_index(start)
+                r1, c1 = _a1_to_index(end)
+                for r in range(r0, r1 + 1):
+                    while len(self.values) <= r:
+                        self.values.append([""] * self.col_count)
+                    for c in range(c0, c1 + 1):
+                        row = self.values[r]
+                        while len(row) <= c:
+                            row.append("")
+                        row[c] = item["values"][r - r0][c - c0]
+
+
+# ============================================================
+#  Gemini（GenerativeModel の代わり）
+# ============================================================
+class FakeModel:
+    """
+    プロンプトの種類を見て決まった答えを返す。呼び出しごとに latency 秒待つ。
+    入力・出力トークン数は文字数から大まかに見積もる。
+    throttle_rate の割合で 429（ResourceExhausted）を返す。
+    """
+
+    model_name = "fake-gemini"
+
+    def __init__(self, latency=0.5, throttle_rate=0.0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _answer(self, parts, kwargs):
+        texts = [p for p in parts if isinstance(p, str)]
+        prompt = texts[0] if texts else ""
+        body = "\n".join(texts[1:])
+
+        if (kwargs.get("generation_config") or {}).get("response_mime_type") == "application/json":
+            rows = json.loads(prompt.split("入力(JSON):\n", 1)[1])
+            answers = {}
+            for row in rows:
+                if "candidates" in row:
+                    answers[row["id"]] = row["candidates"][0]
+                elif "company" in row:
+                    answers[row["id"]] = f"{1000 + int(row['id']) % 9000}"
+                else:
+                    answers[row["id"]] = "対象外"
+            return json.dumps(answers, ensure_ascii=False)
+
+        if "証券コード" in prompt:
+            return "1234"
+        if "候補" in prompt:
+            return re.search(r"-\s*(.+)", prompt).group(1).strip()
+        if "統合してください" in prompt:
+            return VALUE * 2
+        if "会社名" in prompt:
+            m = re.search(r"Bench Corp \d{4}", body)
+            return m.group(0) if m else "Bench Corp"
+        # テキスト版は送られたページにバリューが含まれているときだけ答えられる
+        if body and "Our Values:" not in body:
+            return "取得失敗"
+        return VALUE
+
+    def generate_content(self, contents, **kwargs):
+        parts = contents if isinstance(contents, (list, tuple)) else [contents]
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+        if random.random() < self.throttle_rate:
+            raise api_exceptions.ResourceExhausted("429 RESOURCE_EXHAUSTED (fake)")
+
+        text = self._answer(parts, kwargs)
+        prompt_chars = sum(len(p) for p in parts if isinstance(p, str))
+        images = sum(1 for p in parts if not isinstance(p, str))
+        usage = types.SimpleNamespace(
+            prompt_token_count=prompt_chars // 2 + images * 258,
+            candidates_token_count=len(text) // 2,
+        )
+        return types.SimpleNamespace(text=text, usage_metadata=usage)
+
+
+# ============================================================
+#  PDF（テキスト層あり / スキャン画像のみ）
+# ============================================================
+def _escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+@lru_cache(maxsize=None)
+def text_pdf(n, pages=PAGES):
+    """Helvetica のテキスト層を持つ PDF（xref を正しく持つので strict でも読める）"""
+    lines_by_page = []
+    for p in range(pages):
+        if p == 0:
+            lines = [f"{COMPANY.format(n=n)} Integrated Report 2024", COMPANY.format(n=n)]
+        elif p == 1:
+            lines = ["Contents", f"Our Values ... {VALUE_PAGE}", "Business review ... 16"]
+        else:
+            lines = [f"Page {p + 1}"]
+        lines += [VALUE if p + 1 == VALUE_PAGE else FILLER] * 4
+        lines_by_page.append(lines)
+
+    objects = []  # 1 始まりのオブジェクト番号順
+    page_ids = []
+    font_id = 3
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    objects.append(None)  # Pages は後で埋める
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    for lines in lines_by_page:
+        ops = ["BT", "/F1 10 Tf", "14 TL", "50 800 Td"]
+        for line in lines:
+            ops.append(f"({_escape(line)}) Tj T*")
+        ops.append("ET")
+        stream = "\n".join(ops).encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>" % (font_id, content_id)
+        )
+        page_ids.append(len(objects))
+
+    kids = " ".join(f"{i} 0 R" for i in page_ids).encode()
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % i + obj + b"\nendobj\n")
+
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for off in offsets:
+        out.write(b"%010d 00000 n \n" % off)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+@lru_cache(maxsize=None)
+def scanned_pdf(n, pages=PAGES):
+    """テキスト層のない、ページ画像だけの PDF（スキャンした報告書の代わり）"""
+    images = []
+    for p in range(pages):
+        img = Image.new("L", (620, 877), 255)
+        draw = ImageDraw.Draw(img)
+        draw.text((40, 40), f"{COMPANY.format(n=n)}  page {p + 1}", fill=0)
+        for y in range(80, 840, 16):
+            draw.line((40, y, 40 + (y * 7 + n) % 540, y), fill=96)
+        images.append(img)
+
+    out = io.BytesIO()
+    images[0].save(out, "PDF", save_all=True, append_images=images[1:], resolution=75)
+    return out.getvalue()
+
+
+def fixtures(rows, scanned):
+    """シナリオの各行の PDF を [(種類, 番号), ...] で返す。scanned はスキャン PDF の割合"""
+    every = round(1 / scanned) if scanned > 0 else 0
+    return [("scan" if every and n % every == 0 else "text", n) for n in range(rows)]
+
+
+def sheet_urls(base_url, rows, scanned, duplicates=0.0):
+    """
+    各行の URL を返す。duplicates の割合の行は直前の行と同じ PDF にする
+    （交互に同じ URL と、同じ PDF を別パスで配るミラーの URL）
+    """
+    every = round(1 / duplicates) if duplicates > 0 else 0
+    urls = []
+    mirror = False
+    prev = None
+    for i, (kind, n) in enumerate(fixtures(rows, scanned)):
+        if every and prev and i % every == 0:
+            kind, n = prev
+            urls.append(f"{base_url}/mirror/{kind}/{n}.pdf" if mirror else urls[-1])
+            mirror = not mirror
+            continue
+        prev = kind, n
+        urls.append(f"{base_url}/{kind}/{n}.pdf")
+    return urls
+
+
+def warm_fixtures(rows, scanned):
+    """配信時に PDF を生成すると計測に混ざるので、先にまとめて作っておく"""
+    for kind, n in fixtures(rows, scanned):
+        (text_pdf if kind == "text" else scanned_pdf)(n)
+
+
+class _PdfHandler(BaseHTTPRequestHandler):
+    """
+    GET /text/<n>.pdf, /scan/<n>.pdf（/mirror/ 付きも同じ内容）を返す。
+    Range（bytes=a-b）と ETag（If-None-Match → 304）に対応。
+    error_rate の割合で 503 を返す（再試行の確認用）
+    """
+
+    latency = 0.0
+    range_support = True
+    error_rate = 0.0
+
+    def do_GET(self):
+        m = re.fullmatch(r"(?:/mirror)?/(text|scan)/(\d+)\.pdf", self.path)
+        if not m:
+            self.send_error(404)
+            return
+
+        body = (text_pdf if m.group(1) == "text" else scanned_pdf)(int(m.group(2)))
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        time.sleep(self.latency)
+
+        if random.random() < self.error_rate:
+            self.send_error(503)
+            return
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        rng = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if rng and self.range_support:
+            start = int(rng.group(1))
+            end = min(int(rng.group(2) or len(body) - 1), len(body) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+            body = body[start:end + 1]
+        else:
+            self.send_response(200)
+
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_pdf_server(latency=0.0, range_support=True, error_rate=0.0):
+    """ローカルの PDF 配信サーバーを別スレッドで起動し、(サーバー, ベース URL) を返す"""
+    handler = type("Handler", (_PdfHandler,), {
+        "latency": latency, "range_support": range_support, "error_rate": error_rate,
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="pdf-server", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
@@ -0,0 +1,87 @@
+"""
+起動時の import 時間のチェック。新しいプロセスで `import main` にかかる時間を測り、
+予算を超えるか、重いライブラリ（pandas・Gemini・PDF 系など）が起動時に読み込まれていれば
+終了コード 1 で失敗する。CI やイメージのビルド前に実行する想定。
+
+    python bench/import_budget.py                  # 予算 500ms（IMPORT_BUDGET_MS で変更可）
+    python bench/import_budget.py --budget-ms 300 --top 15
+
+時間は -X importtime の出力から集計し、ばらつきを抑えるため --repeat 回のうち最小値を使う。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 起動時に読み込まれてはいけないモジュール（ステージの初回実行時に読み込む）
+HEAVY_MODULES = [
+    "pandas",
+    "numpy",
+    "gspread",
+    "google.generativeai",
+    "google.api_core",
+    "pypdf",
+    "pdf2image",
+    "PIL",
+]
+
+CHILD = (
+    "import json, sys; import main; "
+    f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+)
+
+
+def measure():
+    """(import main の合計マイクロ秒, 読み込まれた重いモジュール, モジュールごとの累積マイクロ秒) を返す"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD],
+        cwd=ROOT, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import main に失敗しました:\n{proc.stderr}")
+
+    # 行の形式: "import time: self [us] | cumulative | imported package"
+    cumulative = {}
+    total = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cum, name = line[len("import time:"):].split("|")
+        if name.strip() == "main":
+            total = int(cum)
+        cumulative[name.strip()] = int(cum)
+    return total, json.loads(proc.stdout.strip().splitlines()[-1]), cumulative
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", "500")))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10, help="時間のかかったモジュールを何件表示するか")
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(max(1, args.repeat))]
+    total, heavy, cumulative = min(runs, key=lambda r: r[0])
+    total_ms = total / 1000
+
+    print(f"import main: {total_ms:.0f} ms（予算 {args.budget_ms:.0f} ms）")
+    for name, us in sorted(cumulative.items(), key=lambda kv: -kv[1])[:args.top]:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if heavy:
+        print(f"❌ 起動時に読み込まれた重いモジュール: {', '.join(heavy)}")
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f"❌ import 時間が予算を超過: {total_ms:.0f} ms > {args.budget_ms:.0f} ms")
+        failed = True
+    if not failed:
+        print("✅ 予算内")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
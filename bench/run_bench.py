@@ -0,0 +1,155 @@
+"""
+オフラインのベンチマーク。スプレッドシート・Gemini・PDF 配信をすべて偽物に差し替えて
+パイプライン（main.run_pipeline）を通しで実行し、行/秒・最大メモリ・ステージごとの時間を出す。
+
+    python bench/run_bench.py                      # 10 / 100 / 1000 行
+    python bench/run_bench.py --rows 100 --llm-latency 1.0 --output bench_output.txt
+
+並列数などはふだんどおり環境変数（ROW_CONCURRENCY など）で変えられる。
+シナリオごとに別プロセス・空のキャッシュで実行するので、最大メモリはそのシナリオ単独の値になる。
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from fakes import PAGES, FakeModel, FakeWorksheet, sheet_urls, start_pdf_server, warm_fixtures  # noqa: E402
+
+HEADER = ["URL", "ページ数", "会社名T", "会社名G", "会社名", "証券番号", "バリューT", "バリューG", "バリュー"]
+RESULT_PREFIX = "BENCH_RESULT "
+
+
+# ============================================================
+#  子プロセス: 1 シナリオを実行して結果を JSON で出す
+# ============================================================
+def run_scenario(rows, base_url, scanned, llm_latency, llm_429_rate, duplicates):
+    import logging
+    import gemini_client
+    import jobs
+    import main
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    model = FakeModel(llm_latency, llm_429_rate)
+    gemini_client.init_gemini = lambda: model
+
+    sheet_rows = [
+        [url, PAGES] + [""] * (len(HEADER) - 2)
+        for url in sheet_urls(base_url, rows, scanned, duplicates)
+    ]
+    worksheet = FakeWorksheet(HEADER, sheet_rows)
+
+    job = jobs.Job("bench", None)
+    job.started = time.time()
+    main.run_pipeline(worksheet, job)
+    job.finished = time.time()
+
+    result = job.to_dict()
+    filled = sum(1 for r in worksheet.values[1:] if r[HEADER.index("バリュー")] not in ("", "取得失敗", "対象外"))
+    return {
+        "rows": rows,
+        "seconds": result["seconds"],
+        "rows_per_sec": round(rows / result["seconds"], 2) if result["seconds"] else 0,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "stages": {name: s["seconds"] for name, s in result["stages"].items()},
+        "gemini_calls": model.calls,
+        "sheet_calls": worksheet.calls,
+        "sheet_cells_read": worksheet.cells_read,
+        "values_filled": filled,
+        "summary": job.summary,
+    }
+
+
+# ============================================================
+#  親プロセス: PDF 配信サーバーを立て、シナリオごとに子プロセスを起動する
+# ============================================================
+def _spawn(rows, base_url, args):
+    with tempfile.TemporaryDirectory(prefix="bench-") as tmp:
+        env = {
+            **os.environ,
+            "PDF_CACHE_DIR": os.path.join(tmp, "pdf_cache"),
+            "LLM_CACHE_PATH": os.path.join(tmp, "llm_cache.sqlite3"),
+            "JPX_LISTED_FILE": os.path.join(tmp, "none.xls"),
+        }
+        proc = subprocess.run(
+            [
+                sys.executable, os.path.abspath(__file__), "--child",
+                "--rows", str(rows), "--base-url", base_url,
+                "--scanned", str(args.scanned), "--llm-latency", str(args.llm_latency),
+                "--llm-429-rate", str(args.llm_429_rate), "--duplicates", str(args.duplicates),
+            ],
+            env=env, stdout=subprocess.PIPE, text=True,
+        )
+
+    for line in proc.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f"{rows} 行のシナリオが失敗しました（終了コード {proc.returncode}）")
+
+
+def _report(results):
+    stages = list(dict.fromkeys(name for r in results for name in r["stages"]))
+    head = ["rows", "rows/s", "total s", "peak MiB", "gemini", "sheet r/w", "cells read"] + stages
+    lines = ["\t".join(head)]
+    for r in results:
+        sheet = r["sheet_calls"]
+        lines.append("\t".join(str(v) for v in [
+            r["rows"], r["rows_per_sec"], r["seconds"], r["peak_rss_mb"], r["gemini_calls"],
+            f"{sheet['values_get'] + sheet['batch_get']}/{sheet['batch_update']}", r["sheet_cells_read"],
+            *[r["stages"].get(name, "-") for name in stages],
+        ]))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--scanned", type=float, default=0.2, help="スキャン PDF の割合")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Gemini 1 回あたりの秒数")
+    parser.add_argument("--llm-429-rate", type=float, default=0.0, help="Gemini が 429 を返す割合")
+    parser.add_argument("--http-latency", type=float, default=0.05, help="HTTP 1 回あたりの秒数")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="前の行と同じ PDF の行の割合")
+    parser.add_argument("--no-range", action="store_true", help="配信サーバーの Range 対応を切る")
+    parser.add_argument("--http-error-rate", type=float, default=0.0, help="配信サーバーが 503 を返す割合")
+    parser.add_argument("--output", help="結果（表と JSON）を追記するファイル")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_scenario(
+            args.rows[0], args.base_url, args.scanned, args.llm_latency, args.llm_429_rate, args.duplicates,
+        )
+        print(RESULT_PREFIX + json.dumps(result, ensure_ascii=False), flush=True)
+        return
+
+    print("📄 テスト用 PDF を生成中", file=sys.stderr, flush=True)
+    warm_fixtures(max(args.rows), args.scanned)
+    server, base_url = start_pdf_server(args.http_latency, not args.no_range, args.http_error_rate)
+    results = []
+    try:
+        for rows in args.rows:
+            print(f"▶️ {rows} 行", file=sys.stderr, flush=True)
+            results.append(_spawn(rows, base_url, args))
+    finally:
+        server.shutdown()
+
+    table = _report(results)
+    print(table)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(f"# {time.strftime('%Y-%m-%d %H:%M:%S')} {vars(args)}\n{table}\n")
+            for r in results:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import logging
+import os
+
+from pdf_text import get_text_artifact
+from company_index import normalize_company_name
+
+
+# -------------------------------
+# T → G カスケード
+# -------------------------------
+# CASCADE_MODE=1 のとき、テキスト版（T）で十分な結果が出ている行は
+# 画像版（G）の画像化・Gemini 呼び出しを省略し、G 列に SKIPPED を入れる。
+# 会社名・バリューの統合処理では SKIPPED は「無効」として扱われ、T 単独採用になる。
+CASCADE_MODE = os.getenv("CASCADE_MODE", "0") == "1"
+SKIPPED = "省略"
+
+# テキスト層がこれより短ければ（スキャン PDF など）G を実行する
+CASCADE_MIN_TEXT_CHARS = int(os.getenv("CASCADE_MIN_TEXT_CHARS", "200"))
+# バリューT がこれより短ければ G も実行する
+CASCADE_MIN_VALUE_CHARS = int(os.getenv("CASCADE_MIN_VALUE_CHARS", "50"))
+
+INVALID = ["", "取得失敗", "対象外", SKIPPED]
+
+
+def company_name_confident(name, page_texts):
+    """1 行の短い名前で、かつ本文中に出てくる会社名なら信頼できるとみなす"""
+    if len(name) > 40 or "\n" in name or "。" in name or "、" in name:
+        return False
+    key = normalize_company_name(name)
+    return bool(key) and key in normalize_company_name("".join(page_texts))
+
+
+def value_confident(value, page_texts):
+    return len(value) >= CASCADE_MIN_VALUE_CHARS
+
+
+def skip_image_stage(url, t_result, pages, confident):
+    """カスケードモードで、T の結果だけで十分と判断できれば True"""
+    if not CASCADE_MODE or str(t_result).strip() in INVALID:
+        return False
+
+    try:
+        status, artifact = get_text_artifact(url, pages)
+    except Exception as e:
+        # 判定できなければ G を実行する（その行の G の中で取得失敗として扱われる）
+        logging.info(f"↩️ カスケード判定できず G を実行 {e}: {url}")
+        return False
+    if status != 200 or not artifact["has_text_layer"]:
+        return False
+
+    page_texts = artifact["pages"][:pages]
+    if sum(len(t.strip()) for t in page_texts) < CASCADE_MIN_TEXT_CHARS:
+        return False
+
+    if not confident(str(t_result).strip(), page_texts):
+        return False
+
+    logging.info(f"⏭️ G省略（T採用）: {url}")
+    return True
@@ -0,0 +1,125 @@
+import logging
+import difflib
+import os
+import re
+import threading
+import unicodedata
+
+
+# -------------------------------
+# 上場企業一覧（JPX）による証券コード検索
+# -------------------------------
+# JPX の「東証上場銘柄一覧」(data_j.xls) または同じ列を持つ CSV を
+# JPX_LISTED_FILE に置くと、Gemini を呼ぶ前にここで証券コードを引く。
+# ファイルがなければ何もしない（従来どおり Gemini で推定）。
+JPX_LISTED_FILE = os.getenv("JPX_LISTED_FILE", "/data/jpx/data_j.xls")
+
+# あいまい一致を採用する最低スコア（difflib の類似度 0〜1）
+MIN_SCORE = float(os.getenv("COMPANY_INDEX_MIN_SCORE", "0.9"))
+
+# 法人格など、照合の邪魔になる語（NFKC・小文字化の後に除去）
+LEGAL_FORMS = [
+    "株式会社", "(株)", "有限会社", "(有)", "合同会社", "合資会社", "合名会社",
+    "co.,ltd.", "co.,ltd", "co.ltd.", "co.ltd", "inc.", "corporation", "corp.",
+]
+
+_PUNCT = re.compile(r"[\s・･\-‐‑–—ー−.,、。&＆'’\"“”]")
+
+_index = None
+_load_lock = threading.Lock()
+
+
+def normalize_company_name(name):
+    """NFKC → 小文字 → 法人格除去 → カタカナをひらがなに → 記号・空白除去"""
+    text = unicodedata.normalize("NFKC", str(name)).lower()
+    for form in LEGAL_FORMS:
+        text = text.replace(form, "")
+    text = "".join(
+        chr(ord(ch) - 0x60) if "ァ" <= ch <= "ヶ" else ch
+        for ch in text
+    )
+    return _PUNCT.sub("", text)
+
+
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+class CompanyIndex:
+    def __init__(self, rows):
+        self.exact = {}
+        self.grams = {}
+
+        for name, code in rows:
+            key = normalize_company_name(name)
+            if not key or key in self.exact:
+                continue
+            self.exact[key] = code
+            for gram in _bigrams(key):
+                self.grams.setdefault(gram, []).append(key)
+
+    def __len__(self):
+        return len(self.exact)
+
+    def lookup(self, name):
+        """確信できる一致があれば証券コード、なければ None"""
+        key = normalize_company_name(name)
+        if not key:
+            return None
+
+        code = self.exact.get(key)
+        if code:
+            return code
+
+        # 2 文字の共通部分を持つ候補だけを類似度で比較する
+        candidates = set()
+        for gram in _bigrams(key):
+            candidates.update(self.grams.get(gram, ()))
+
+        scored = sorted(
+            ((difflib.SequenceMatcher(None, key, c).ratio(), c) for c in candidates),
+            reverse=True,
+        )
+        if not scored or scored[0][0] < MIN_SCORE:
+            return None
+
+        # 同点の別会社があれば曖昧なので採用しない
+        if len(scored) > 1 and scored[1][0] == scored[0][0]:
+            return None
+        return self.exact[scored[0][1]]
+
+
+def _read_listed_file(path):
+    import pandas as pd  # 起動時間を短くするため、一覧を読むときに初めて読み込む
+
+    if path.lower().endswith(".csv"):
+        df = pd.read_csv(path, dtype=str)
+    else:
+        df = pd.read_excel(path, dtype=str)
+    df.fillna('', inplace=True)
+
+    # ETF・REIT などを除き、株式のみ対象にする
+    if "市場・商品区分" in df.columns:
+        df = df[df["市場・商品区分"].str.contains("内国株式")]
+
+    codes = df["コード"].str.strip().str.replace(r"\.0$", "", regex=True)
+    return list(zip(df["銘柄名"], codes))
+
+
+def get_company_index():
+    global _index
+    with _load_lock:
+        if _index is None:
+            rows = []
+            if os.path.exists(JPX_LISTED_FILE):
+                try:
+                    rows = _read_listed_file(JPX_LISTED_FILE)
+                except Exception as e:
+                    logging.warning(f"⚠️ 上場企業一覧の読込失敗 {e}: {JPX_LISTED_FILE}")
+            _index = CompanyIndex(rows)
+            logging.info(f"📇 上場企業一覧: {len(_index)} 社")
+    return _index
+
+
+def lookup_security_code(company):
+    return get_company_index().lookup(company)
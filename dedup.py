@@ -0,0 +1,114 @@
+import logging
+import os
+
+import metrics
+from pdf_cache import cached_digest
+from company_index import normalize_company_name
+
+
+# -------------------------------
+# 行をまたいだ重複処理をまとめる
+# -------------------------------
+# シートには同じ報告書の URL（やミラー）が複数行あり、同じ会社の行も年度ごとに並ぶ。
+# 行ごとに処理すると同じダウンロード・同じ Gemini 呼び出しを何度も行うので、
+# 処理の入力からグループのキーを作り、グループごとに 1 回だけ処理して結果を全行に書く。
+#   PDF を読むステージ: URL。PDF がキャッシュ済みなら内容ハッシュ（別 URL のミラーも同じグループ）
+#   証券番号          : 正規化した会社名
+# キーにはそれ以外の入力（カスケード時の会社名T など）も含めるので、入力が違う行はまとめない。
+# DEDUP_ROWS=0 で無効（従来どおり行ごとに処理する）
+DEDUP_ROWS = os.getenv("DEDUP_ROWS", "1") != "0"
+
+
+def pdf_key(args):
+    """(url, その他の入力...) → キャッシュ済みなら内容ハッシュ、なければ URL で作ったキー"""
+    url, *rest = args
+    digest = cached_digest(url)
+    source = ("sha256", digest) if digest else ("url", url.strip())
+    return (source, *rest)
+
+
+def company_key(item):
+    """{"company": 会社名} → 正規化した会社名（空ならまとめない）"""
+    return normalize_company_name(item["company"]) or None
+
+
+def group_tasks(tasks, key, stage):
+    """
+    ステージ一括処理用。tasks = [(idx, 入力), ...] を key(入力) でまとめ、
+    (グループの代表だけのタスク一覧, {代表の idx: [グループ全員の idx]}) を返す。
+    """
+    members = {idx: [idx] for idx, _ in tasks}
+    if not DEDUP_ROWS:
+        return tasks, members
+
+    leaders = {}
+    unique = []
+    for idx, payload in tasks:
+        k = key(payload)
+        leader = leaders.get(k) if k is not None else None
+        if leader is None:
+            if k is not None:
+                leaders[k] = idx
+            unique.append((idx, payload))
+        else:
+            members[leader].append(idx)
+            del members[idx]
+
+    saved = len(tasks) - len(unique)
+    if saved:
+        metrics.inc("dedup_rows_total", saved, stage=stage)
+        logging.info(f"🧩 重複をまとめて処理（{stage}）: {len(tasks)} 行 → {len(unique)} 件")
+    return unique, members
+
+
+RUN, WAIT, DONE = "run", "wait", "done"
+
+
+class RowGroups:
+    """
+    行単位スケジューラ用。行は別々のタイミングで着手されるので、
+    同じキーの処理が実行中なら結果を待ち、済んでいればその結果を使う。
+    """
+    def __init__(self, stage, key):
+        self.stage = stage
+        self.key = key if DEDUP_ROWS else None
+        self._leaders = {}  # 代表の idx → (キー, 入力)
+        self._waiting = {}  # キー → 結果待ちの idx 一覧
+        self._results = {}  # キー → 結果
+
+    def join(self, idx, payload):
+        """
+        (RUN, None)  : この行で処理する（終わったら resolve を呼ぶ）
+        (WAIT, None) : 同じ処理が実行中（代表の resolve で結果を受け取る）
+        (DONE, 結果) : 同じ処理が済んでいる
+        """
+        if self.key is None:
+            return RUN, None
+        k = self.key(payload)
+        if k is None:
+            return RUN, None
+
+        if k in self._results:
+            metrics.inc("dedup_rows_total", stage=self.stage)
+            return DONE, self._results[k]
+        if k in self._waiting:
+            metrics.inc("dedup_rows_total", stage=self.stage)
+            self._waiting[k].append(idx)
+            return WAIT, None
+
+        self._leaders[idx] = (k, payload)
+        self._waiting[k] = []
+        return RUN, None
+
+    def resolve(self, idx, result):
+        """代表の行 idx の結果を記録し、その結果を書く行（idx 自身と待っていた行）を返す"""
+        if idx not in self._leaders:
+            return [idx]
+
+        k, payload = self._leaders.pop(idx)
+        self._results[k] = result
+        # URL で待ち合わせた処理は、ダウンロード後に内容ハッシュのキーでも引けるようにする
+        after = self.key(payload)
+        if after is not None and after != k:
+            self._results.setdefault(after, result)
+        return [idx] + self._waiting.pop(k)
@@ -0,0 +1,213 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+from run_budget import current_run
+
+
+# -------------------------------
+# 並列実行の上限（環境変数で調整）
+# -------------------------------
+# ROW_CONCURRENCY : 同時に処理する行数（ワーカースレッド数）
+# HTTP_CONCURRENCY: 同時に行う PDF ダウンロード数
+# LLM_CONCURRENCY : 同時に行う Gemini 呼び出し数の上限（実際の数は gemini_client が 429 に応じて調整）
+ROW_CONCURRENCY = int(os.getenv("ROW_CONCURRENCY", "8"))
+HTTP_CONCURRENCY = int(os.getenv("HTTP_CONCURRENCY", "4"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+
+_http_slots = threading.BoundedSemaphore(HTTP_CONCURRENCY)
+
+
+def http_slot():
+    """`with http_slot():` で囲んだ区間の同時実行数を HTTP_CONCURRENCY に制限する"""
+    return _http_slots
+
+
+# -------------------------------
+# メモリ予算
+# -------------------------------
+# MEMORY_BUDGET_MB : メモリ使用量がこれを超えている間は、重い処理（ダウンロード・PDF 解析・画像化）の
+#                    新規着手を待たせる。0 ならコンテナのメモリ上限の MEMORY_BUDGET_RATIO 倍
+#                    （上限が分からなければ無効）
+# 使用量はコンテナ（cgroup）のワーキングセット（再利用できるページキャッシュを除く）。
+# Cloud Run の /tmp（PDF キャッシュ）もここに含まれる。cgroup が読めなければプロセスの RSS を使う。
+# 少なくとも 1 件は常に実行できるので、予算を超えたまま止まることはない。
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "0"))
+MEMORY_BUDGET_RATIO = float(os.getenv("MEMORY_BUDGET_RATIO", "0.8"))
+MEMORY_POLL_SECONDS = 0.2
+
+_CGROUP_FILES = [
+    # (使用量, 上限, memory.stat の inactive_file の項目名)
+    ("/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory.max", "inactive_file"),
+    ("/sys/fs/cgroup/memory/memory.usage_in_bytes", "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+     "total_inactive_file"),
+]
+
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _cgroup():
+    for usage, limit, inactive_key in _CGROUP_FILES:
+        if os.path.exists(usage):
+            return usage, limit, inactive_key
+    return None
+
+
+def memory_usage():
+    """現在のメモリ使用量（バイト）"""
+    if _cgroup_files is not None:
+        usage_path, _, inactive_key = _cgroup_files
+        usage = _read_int(usage_path)
+        if usage is not None:
+            stat_path = os.path.join(os.path.dirname(usage_path), "memory.stat")
+            try:
+                with open(stat_path) as f:
+                    for line in f:
+                        key, _, value = line.partition(" ")
+                        if key == inactive_key:
+                            return max(0, usage - int(value))
+            except (OSError, ValueError):
+                pass
+            return usage
+
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _memory_budget():
+    if MEMORY_BUDGET_MB > 0:
+        return MEMORY_BUDGET_MB * 1024 * 1024
+    if _cgroup_files is None:
+        return 0
+    limit = _read_int(_cgroup_files[1])  # cgroup v2 で上限なしは "max"（None になる）
+    # cgroup v1 で上限なしはページ境界に丸めた巨大な値になる
+    if limit is None or limit >= 1 << 60:
+        return 0
+    return limit * MEMORY_BUDGET_RATIO
+
+
+class _MemoryGate:
+    def __init__(self, budget):
+        self.budget = budget
+        self.active = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def __enter__(self):
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        # 同じスレッドで入れ子になった区間（解析中の部分取得など）は待たない
+        if self.budget <= 0 or depth > 0:
+            return self
+
+        with self._cond:
+            started = None
+            while self.active > 0 and memory_usage() > self.budget:
+                if started is None:
+                    started = time.monotonic()
+                    metrics.inc("memory_throttled_total")
+                    logging.info(f"🧠 メモリ予算超過のため待機（実行中 {self.active} 件）")
+                self._cond.wait(MEMORY_POLL_SECONDS)
+            if started is not None:
+                metrics.observe("memory_wait_seconds", time.monotonic() - started)
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._local.depth -= 1
+        if self.budget <= 0 or self._local.depth > 0:
+            return
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+
+_cgroup_files = _cgroup()
+_memory_gate = _MemoryGate(_memory_budget())
+
+
+def memory_slot():
+    """`with memory_slot():` で囲んだ重い処理は、メモリ予算を超えている間は着手を待つ"""
+    return _memory_gate
+
+
+# -------------------------------
+# キーごとのロック
+# -------------------------------
+class KeyedLocks:
+    """
+    `with locks.hold(key):` で同じキー（URL・入力のハッシュなど）の処理を 1 つずつにする。
+    ロックは使用中の間だけ持ち、誰も使わなくなったら捨てる（長く動くプロセスでも増え続けない）。
+    """
+
+    def __init__(self, reentrant=False):
+        self._factory = threading.RLock if reentrant else threading.Lock
+        self._lock = threading.Lock()
+        self._locks = {}  # キー → [ロック, 使用中・待機中の数]
+
+    @contextmanager
+    def hold(self, key):
+        with self._lock:
+            entry = self._locks.setdefault(key, [self._factory(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+def run_rows(func, tasks, key=None):
+    """
+    tasks = [(idx, 引数タプル), ...] を func(*引数) でスレッド並列に処理し、
+    終わったものから (idx, 戻り値) を返すジェネレータ。
+    key を渡すと key(task) の昇順（優先度順）に着手する。
+    DataFrame への書き込みは呼び出し側（メインスレッド）で行うこと。
+    func 内の例外はそのまま呼び出し側に伝わるので、func 側で処理しておく。
+
+    パイプライン実行中は、実行時間の予算を使い切った時点で新しい行に着手しない。
+    1 件が複数行分（まとめた問い合わせ・重複をまとめた代表）のこともあるので、
+    チェックポイントの判定は呼び出し側が書き込んだ行ごとに run_budget.row_done() で行う。
+    """
+    if not tasks:
+        return
+
+    run = current_run()
+    pending = deque(sorted(tasks, key=key) if key else tasks)
+    workers = max(1, min(ROW_CONCURRENCY, len(pending)))
+    logging.info(f"⚙️ 並列処理: {len(pending)} 行 / {workers} スレッド")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+
+        def submit():
+            # 予算切れでなければ、同時実行数の 2 倍まで先行して投入する
+            while pending and len(running) < workers * 2:
+                if run is not None and run.expired():
+                    logging.warning(f"⏰ 実行時間の予算切れ: 未着手 {len(pending)} 行は次回に持ち越し")
+                    pending.clear()
+                    return
+                idx, args = pending.popleft()
+                running[pool.submit(func, *args)] = idx
+
+        submit()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx = running.pop(future)
+                yield idx, future.result()
+            submit()
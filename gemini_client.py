@@ -0,0 +1,224 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import metrics
+from executor import LLM_CONCURRENCY
+
+
+# -------------------------------
+# Gemini 共通クライアント（全ステージで 1 つ）
+# -------------------------------
+# GEMINI_MODEL     : 使うモデル名
+# GEMINI_RPM       : 1 分あたりのリクエスト数の上限（トークンバケット）
+# GEMINI_TPM       : 1 分あたりのトークン数の上限（送信前は見積もり、応答後に実績で補正）
+# GEMINI_RETRIES   : 429 / 5xx / タイムアウト時の再試行回数
+# GEMINI_BACKOFF   : 再試行の待ち時間の基準秒数（2 倍ずつ増やし、0〜その値でランダムに待つ）
+# 同時実行数は LLM_CONCURRENCY を上限に、429（RESOURCE_EXHAUSTED）で半分に減らし、
+# 成功が続いたら 1 ずつ戻す（AIMD）。
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "1000"))
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", "1000000"))
+GEMINI_RETRIES = int(os.getenv("GEMINI_RETRIES", "4"))
+GEMINI_BACKOFF = float(os.getenv("GEMINI_BACKOFF", "2.0"))
+GEMINI_BACKOFF_MAX = 60.0
+
+# 画像 1 枚あたりの見積もりトークン数（長辺 1600px の JPEG はおおむね数タイル分）
+IMAGE_TOKENS = 1000
+# 429 の後、次に同時実行数を減らすまでの間隔（同時に返ってきた 429 でまとめて減らさない）
+DECREASE_COOLDOWN = 5.0
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def init_gemini():
+    # google.generativeai は読み込みに 1 秒近くかかるので、最初に使うときまで遅らせる
+    import google.generativeai as genai
+
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        raise RuntimeError("環境変数 GEMINI_API_KEY が設定されていません")
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(GEMINI_MODEL)
+
+
+def get_model():
+    """共有の GenerativeModel（初回呼び出し時に 1 回だけ初期化）"""
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = init_gemini()
+        return _model
+
+
+# ============================================================
+#  レート制限（トークンバケット）
+# ============================================================
+class TokenBucket:
+    """per_minute / 分で補充される容量 per_minute のバケット。0 以下なら無制限"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def take(self, amount):
+        """amount だけ取り出す。足りなければ貯まるまで待つ"""
+        if self.capacity <= 0:
+            return
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                wait = (amount - self.level) * 60 / self.capacity
+            time.sleep(wait)
+
+    def adjust(self, amount):
+        """見積もりとの差を後から精算する（マイナスなら返却）"""
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self.level = min(self.capacity, self.level - amount)
+
+
+# ============================================================
+#  同時実行数の自動調整（AIMD）
+# ============================================================
+class AdaptiveLimit:
+    def __init__(self, maximum):
+        self.maximum = max(1, maximum)
+        self.limit = self.maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            if self.limit >= self.maximum:
+                return
+            self.successes += 1
+            if self.successes >= self.limit:
+                self.successes = 0
+                self.limit += 1
+                logging.info(f"🐇 Gemini 同時実行数を {self.limit} に拡大")
+                self._cond.notify_all()
+
+    def on_throttled(self):
+        with self._cond:
+            now = time.monotonic()
+            if now - self.last_decrease < DECREASE_COOLDOWN:
+                return
+            self.last_decrease = now
+            self.successes = 0
+            if self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                logging.warning(f"🐢 Gemini 同時実行数を {self.limit} に縮小（429）")
+
+
+_requests = TokenBucket(GEMINI_RPM)
+_tokens = TokenBucket(GEMINI_TPM)
+_limit = AdaptiveLimit(LLM_CONCURRENCY)
+
+
+def _estimate_tokens(contents):
+    """送信前の見積もり。日本語は 1 文字 ≒ 1 トークンとして多めに見る"""
+    total = 0
+    for part in contents if isinstance(contents, (list, tuple)) else [contents]:
+        total += len(part) if isinstance(part, str) else IMAGE_TOKENS
+    return total
+
+
+def _is_throttled(e):
+    from google.api_core import exceptions as api_exceptions
+
+    if isinstance(e, (api_exceptions.ResourceExhausted, api_exceptions.TooManyRequests)):
+        return True
+    # 例外の種類で判定できない場合は HTTP ステータス（文言中の数字は見ない）
+    return getattr(e, "code", None) == 429
+
+
+def _is_retryable(e):
+    from google.api_core import exceptions as api_exceptions
+
+    retryable = (
+        api_exceptions.ResourceExhausted,
+        api_exceptions.TooManyRequests,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.InternalServerError,
+        api_exceptions.DeadlineExceeded,
+    )
+    return isinstance(e, retryable) or _is_throttled(e)
+
+
+def _count_tokens(response, version):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return None
+    prompt = getattr(usage, "prompt_token_count", 0) or 0
+    output = getattr(usage, "candidates_token_count", 0) or 0
+    metrics.inc("gemini_tokens_total", prompt, direction="input", version=version)
+    metrics.inc("gemini_tokens_total", output, direction="output", version=version)
+    return prompt + output
+
+
+def generate(model, contents, version="", **kwargs):
+    """
+    model.generate_content(contents, **kwargs) をレート制限・同時実行数の調整付きで呼ぶ。
+    応答生成は副作用のない呼び出しなので、429 / 5xx / タイムアウトは待って再試行する。
+    """
+    estimate = _estimate_tokens(contents)
+
+    for attempt in range(GEMINI_RETRIES + 1):
+        _requests.take(1)
+        _tokens.take(estimate)
+        try:
+            with _limit:
+                started = time.monotonic()
+                try:
+                    response = model.generate_content(contents, **kwargs)
+                finally:
+                    metrics.observe("gemini_request_seconds", time.monotonic() - started, version=version)
+                    metrics.inc("gemini_requests_total", version=version)
+        except Exception as e:
+            if _is_throttled(e):
+                metrics.inc("gemini_throttled_total", version=version)
+                _limit.on_throttled()
+            if not _is_retryable(e) or attempt == GEMINI_RETRIES:
+                raise
+            wait = random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF * 2 ** attempt))
+            logging.info(f"🔁 Gemini 再試行 {attempt + 1}/{GEMINI_RETRIES}（{wait:.1f} 秒後）{e}")
+            metrics.inc("gemini_retries_total", version=version)
+            time.sleep(wait)
+            continue
+
+        _limit.on_success()
+        used = _count_tokens(response, version)
+        if used is not None:
+            _tokens.adjust(used - estimate)
+        return response
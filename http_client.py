@@ -0,0 +1,142 @@
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from executor import HTTP_CONCURRENCY, http_slot, memory_slot
+
+
+# -------------------------------
+# ダウンロード用の共通 HTTP クライアント
+# -------------------------------
+# HTTP_PER_HOST    : 同じホストへの同時接続数（全体の上限は HTTP_CONCURRENCY）
+# HTTP_RETRIES     : 429 / 5xx / タイムアウト・接続エラー時の再試行回数
+# HTTP_BACKOFF     : 再試行の待ち時間の基準秒数（2 倍ずつ増やし、0〜その値でランダムに待つ）
+# HTTP_BACKOFF_MAX : 1 回の待ち時間の上限秒数（Retry-After もこの値で打ち切る）
+# PDF_MAX_BYTES    : これより大きい本体は途中で打ち切って ResponseTooLarge にする
+# PDF 本体は download() でファイルに少しずつ書き出し、メモリに丸ごと載せない。
+HEADERS = {'User-Agent': 'Mozilla/5.0'}
+
+HTTP_PER_HOST = int(os.getenv("HTTP_PER_HOST", "2"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "1.0"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "30"))
+PDF_MAX_BYTES = int(os.getenv("PDF_MAX_BYTES", str(100 * 1024 * 1024)))
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+CHUNK_SIZE = 64 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+_host_slots = {}
+
+
+class ResponseTooLarge(OSError):
+    pass
+
+
+def _get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(HTTP_CONCURRENCY, HTTP_PER_HOST))
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def _host_slot(url):
+    host = urlsplit(url).netloc
+    with _session_lock:
+        return _host_slots.setdefault(host, threading.BoundedSemaphore(HTTP_PER_HOST))
+
+
+def _backoff(attempt, res=None):
+    """attempt 回目の失敗後に待つ秒数。Retry-After（秒）があればそれを優先する"""
+    retry_after = res.headers.get("Retry-After", "") if res is not None else ""
+    if retry_after.isdigit():
+        return min(float(retry_after), HTTP_BACKOFF_MAX)
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF * 2 ** attempt))
+
+
+def _stream_body(res, url, write):
+    """本体を CHUNK_SIZE ずつ write に渡し、バイト数を返す"""
+    length = res.headers.get("Content-Length", "")
+    if length.isdigit() and int(length) > PDF_MAX_BYTES:
+        raise ResponseTooLarge(f"サイズ超過 {length} bytes: {url}")
+
+    size = 0
+    for chunk in res.iter_content(CHUNK_SIZE):
+        size += len(chunk)
+        if size > PDF_MAX_BYTES:
+            raise ResponseTooLarge(f"サイズ超過 {size}+ bytes: {url}")
+        write(chunk)
+    return size
+
+
+def _save_body(res, url, path):
+    """本体を path に書き出し、(バイト数, sha256) を返す"""
+    digest = hashlib.sha256()
+
+    def write(chunk):
+        f.write(chunk)
+        digest.update(chunk)
+
+    with open(path, "wb") as f:
+        size = _stream_body(res, url, write)
+    return size, digest.hexdigest()
+
+
+def _get_once(url, headers, timeout, kind, path):
+    """(レスポンス, 本体の sha256) を返す。本体は 200 / 206 のときだけ path に書き出す"""
+    with _host_slot(url), http_slot():
+        started = time.monotonic()
+        with _get_session().get(url, headers=headers, timeout=timeout, stream=True) as res:
+            if res.status_code not in (200, 206):
+                size, digest = 0, ""
+            else:
+                size, digest = _save_body(res, url, path)
+        metrics.observe("pdf_download_seconds", time.monotonic() - started, kind=kind)
+    metrics.inc("pdf_download_bytes_total", size, kind=kind)
+    metrics.observe("pdf_download_size_bytes", size, kind=kind)
+    return res, digest
+
+
+def download(url, timeout, kind, path, headers=None):
+    """
+    GET して 200 / 206 の本体を path に書き出し、(レスポンス, 本体の sha256) を返す。
+    本体はメモリに溜めない。200 / 206 以外なら sha256 は空文字。
+    429 / 5xx / タイムアウト・接続エラーは HTTP_RETRIES 回まで待ってから再試行し、
+    それでも失敗したら最後のレスポンスを返す（例外の場合はそのまま送出）。
+    """
+    return _get_with_retries(url, timeout, kind, headers, path)
+
+
+def _get_with_retries(url, timeout, kind, headers, path):
+    headers = {**HEADERS, **(headers or {})}
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            # メモリ予算の枠は取得中だけ使い、再試行までの待ち時間には持ち越さない
+            with memory_slot():
+                res, digest = _get_once(url, headers, timeout, kind, path)
+        except (requests.Timeout, requests.ConnectionError) as e:
+            if attempt == HTTP_RETRIES:
+                raise
+            wait = _backoff(attempt)
+            logging.info(f"🔁 再試行 {attempt + 1}/{HTTP_RETRIES}（{wait:.1f} 秒後）{e}: {url}")
+        else:
+            if res.status_code not in RETRY_STATUS or attempt == HTTP_RETRIES:
+                return res, digest
+            wait = _backoff(attempt, res)
+            logging.info(f"🔁 再試行 {attempt + 1}/{HTTP_RETRIES}（{wait:.1f} 秒後）{res.status_code}: {url}")
+
+        metrics.inc("http_retries_total", kind=kind)
+        time.sleep(wait)
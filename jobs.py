@@ -0,0 +1,164 @@
+import logging
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+
+# -------------------------------
+# 非同期ジョブ（POST / で受け付け、バックグラウンドで実行）
+# -------------------------------
+# 同じシートに対するジョブは同時に 1 つだけ（キュー待ち・実行中のものがあればそれを返す）。
+# ロックはプロセス内のみ有効なので、Cloud Run では max-instances=1 とし、
+# レスポンス後も処理を続けるため「CPU を常に割り当てる」設定で動かすこと。
+MAX_JOBS_KEPT = 50
+
+_jobs = {}
+_active = {}
+_lock = threading.Lock()
+_queue = queue.Queue()
+_worker = None
+
+
+class Job:
+    def __init__(self, key, target):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.target = target
+        self.status = "queued"
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.stages = {}
+        self.errors = []
+        self.summary = None
+        # 進捗はジョブのスレッドが書き、/jobs/<id> のスレッドが読む
+        self._lock = threading.Lock()
+
+    # ---- 進捗報告（パイプラインから呼ばれる） ----
+    def stage_started(self, name):
+        with self._lock:
+            self.stages[name] = {"status": "running", "rows": 0, "started": time.time()}
+
+    def stage_progress(self, name, rows):
+        with self._lock:
+            self.stages[name]["rows"] = rows
+
+    def stage_finished(self, name, rows, error=None):
+        with self._lock:
+            stage = self.stages[name]
+            stage["rows"] = rows
+            stage["finished"] = time.time()
+            stage["status"] = "failed" if error else "done"
+            if error:
+                self.errors.append(f"{name}: {error}")
+
+    def to_dict(self):
+        now = time.time()
+        with self._lock:
+            snapshot = {name: dict(stage) for name, stage in self.stages.items()}
+            errors = list(self.errors)
+
+        stages = {}
+        for name, stage in snapshot.items():
+            seconds = (stage.get("finished") or now) - stage["started"]
+            stages[name] = {
+                "status": stage["status"],
+                "rows": stage["rows"],
+                "seconds": round(seconds, 1),
+                "rows_per_sec": round(stage["rows"] / seconds, 2) if seconds > 0 else 0,
+            }
+
+        rows = sum(s["rows"] for s in snapshot.values())
+        seconds = ((self.finished or now) - self.started) if self.started else 0
+        return {
+            "id": self.id,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "rows": rows,
+            "seconds": round(seconds, 1),
+            "rows_per_sec": round(rows / seconds, 2) if seconds > 0 else 0,
+            "stages": stages,
+            "errors": errors,
+            "summary": self.summary,
+        }
+
+
+def _run(job):
+    job.status = "running"
+    job.started = time.time()
+    logging.info(f"🏃 ジョブ開始: {job.id}")
+    try:
+        job.target(job)
+        job.status = "done"
+    except Exception as e:
+        job.status = "failed"
+        with job._lock:
+            job.errors.append(f"{e}")
+        logging.error(f"❌ ジョブ失敗 {job.id}:\n" + traceback.format_exc())
+    finally:
+        job.finished = time.time()
+        with _lock:
+            _active.pop(job.key, None)
+        logging.info(f"🏁 ジョブ終了: {job.id} ({job.status})")
+
+
+def _work():
+    while True:
+        _run(_queue.get())
+
+
+def _forget_old_jobs():
+    """終わったジョブを古い順に捨て、MAX_JOBS_KEPT 件まで残す（_lock 保持中に呼ぶ）"""
+    finished = [j for j in _jobs.values() if j.finished]
+    for job in sorted(finished, key=lambda j: j.finished)[:max(0, len(_jobs) - MAX_JOBS_KEPT)]:
+        del _jobs[job.id]
+
+
+def submit(key, target):
+    """
+    target(job) をバックグラウンドで実行するジョブを登録し、(ジョブ, 新規かどうか) を返す。
+    同じ key のジョブが待機中・実行中なら、新しく登録せずにそれを返す。
+    """
+    global _worker
+    with _lock:
+        if key in _active:
+            return _active[key], False
+
+        job = Job(key, target)
+        _jobs[job.id] = job
+        _active[key] = job
+        _forget_old_jobs()
+
+        if _worker is None:
+            _worker = threading.Thread(target=_work, name="job-worker", daemon=True)
+            _worker.start()
+
+    _queue.put(job)
+    logging.info(f"📮 ジョブ受付: {job.id}")
+    return job, True
+
+
+def run_exclusive(key, target):
+    """
+    同期実行用。同じ key のジョブが待機中・実行中なら実行せず None を返す。
+    そうでなければ target(job) をこのスレッドで実行して終わったジョブを返す。
+    """
+    with _lock:
+        if key in _active:
+            return None
+        job = Job(key, target)
+        _jobs[job.id] = job
+        _active[key] = job
+        _forget_old_jobs()
+
+    _run(job)
+    return job
+
+
+def get(job_id):
+    with _lock:
+        return _jobs.get(job_id)
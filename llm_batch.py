@@ -0,0 +1,122 @@
+import logging
+import json
+import os
+import re
+
+from executor import run_rows
+from llm_cache import generate_text, get_answer, put_answer
+
+
+# -------------------------------
+# 複数行をまとめて 1 回の Gemini 呼び出しで処理する
+# -------------------------------
+# 1 プロンプトに詰める行数。1 以下ならまとめずに 1 行ずつ呼ぶ
+LLM_BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", "20"))
+# 行単位スケジューラで、まとめるために問い合わせを溜めておく最大秒数
+LLM_BATCH_WAIT = float(os.getenv("LLM_BATCH_WAIT", "2"))
+
+# まとめた問い合わせの回答は、行ごとに (モデル, ROW_VERSION, 指示文 + その行の入力) をキーにしても保存する。
+# まとめ方（同じバッチに入る行・行番号）が変わっても、同じ入力の行は API を呼ばずに済む。
+ROW_VERSION = "batch-row/v1"
+
+OUTPUT_RULE = """
+出力は入力の id をキー、回答を値とする JSON オブジェクトのみ（例: {"12": "回答"}）。
+全ての id について必ず回答すること。
+"""
+
+
+def _parse_answers(text):
+    """応答から {id: 回答} を取り出す。コードブロックで囲まれていても可"""
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text.strip())
+    answers = json.loads(text)
+    if not isinstance(answers, dict):
+        raise ValueError("JSON オブジェクトではありません")
+    return {str(k): str(v).strip() for k, v in answers.items()}
+
+
+def _ask_batch(model, instruction, chunk, validate):
+    """
+    chunk = [(idx, 入力 dict), ...] の回答を {str(idx): 回答} で返す。validate を満たす回答だけを含む。
+    行ごとのキャッシュにある行は問い合わせず、残りをまとめて 1 回で問い合わせる。
+    """
+    answers = {}
+    pending = []
+    for idx, item in chunk:
+        cached = get_answer(model, ROW_VERSION, [instruction, item])
+        if cached is not None:
+            answers[str(idx)] = cached
+        else:
+            pending.append((idx, item))
+    if not pending:
+        return answers
+
+    payload = [{"id": str(idx), **item} for idx, item in pending]
+    prompt = (
+        instruction
+        + OUTPUT_RULE
+        + "\n入力(JSON):\n"
+        + json.dumps(payload, ensure_ascii=False)
+    )
+
+    try:
+        text = generate_text(
+            model, prompt, "batch/v1",
+            generation_config={"response_mime_type": "application/json"},
+        )
+        parsed = _parse_answers(text)
+    except Exception as e:
+        logging.warning(f"⚠️ バッチ応答を解釈できず {len(pending)} 件を個別処理へ: {e}")
+        return answers
+
+    for idx, item in pending:
+        answer = parsed.get(str(idx))
+        if answer is not None and validate(item, answer):
+            answers[str(idx)] = answer
+            put_answer(model, ROW_VERSION, [instruction, item], answer)
+    return answers
+
+
+def run_batched(model, instruction, tasks, validate, fallback):
+    """
+    tasks = [(idx, 入力 dict), ...] を LLM_BATCH_SIZE 件ずつ 1 プロンプトにまとめて問い合わせ、
+    (idx, 回答) を返すジェネレータ。
+    validate(入力 dict, 回答) を満たさない行（欠落・解釈不能を含む）は
+    fallback(入力 dict) で 1 件ずつ処理し直す。
+    """
+    if LLM_BATCH_SIZE <= 1:
+        yield from run_rows(fallback, [(idx, (item,)) for idx, item in tasks])
+        return
+
+    chunks = [tasks[i:i + LLM_BATCH_SIZE] for i in range(0, len(tasks), LLM_BATCH_SIZE)]
+    batches = [(n, (model, instruction, chunk, validate)) for n, chunk in enumerate(chunks)]
+
+    retry = []
+    for n, answers in run_rows(_ask_batch, batches):
+        for idx, item in chunks[n]:
+            answer = answers.get(str(idx))
+            if answer is not None:
+                yield idx, answer
+            else:
+                retry.append((idx, (item,)))
+
+    if retry:
+        logging.info(f"🔁 個別処理にフォールバック: {len(retry)} 件")
+        yield from run_rows(fallback, retry)
+
+
+def ask_batch(model, instruction, chunk, validate, fallback):
+    """
+    行単位スケジューラ用。chunk = [(idx, 入力 dict), ...] を 1 回で問い合わせ、
+    [(idx, 回答), ...] を返す。validate を満たさない行はこのスレッドで fallback する。
+    """
+    if LLM_BATCH_SIZE <= 1:
+        return [(idx, fallback(item)) for idx, item in chunk]
+
+    answers = _ask_batch(model, instruction, chunk, validate)
+    results = []
+    for idx, item in chunk:
+        answer = answers.get(str(idx))
+        if answer is None:
+            answer = fallback(item)
+        results.append((idx, answer))
+    return results
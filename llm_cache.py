@@ -0,0 +1,163 @@
+import logging
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import gemini_client
+import metrics
+from executor import KeyedLocks
+
+
+# -------------------------------
+# Gemini 応答キャッシュ（SQLite）
+# -------------------------------
+# キー = (モデル名, プロンプト版, 入力内容の sha256)。
+# 同じ入力には API を呼ばずに前回の応答を返す。
+# 版 (version) は呼び出し側のプロンプトごとの名前。プロンプトや前処理を変えたら上げる。
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "/tmp/llm_cache.sqlite3")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(30 * 24 * 3600)))  # 秒
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "50000"))
+
+_conn = None
+_lock = threading.Lock()
+_puts = 0
+_key_locks = KeyedLocks()
+
+
+def _connect():
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(LLM_CACHE_PATH) or ".", exist_ok=True)
+        _conn = sqlite3.connect(LLM_CACHE_PATH, check_same_thread=False)
+        _conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                version TEXT,
+                response TEXT,
+                created REAL,
+                accessed REAL
+            )
+        """)
+        _conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON responses(accessed)")
+        _conn.commit()
+    return _conn
+
+
+def _digest(contents):
+    """文字列・bytes・画像（PIL / {"mime_type", "data"}）の並びから sha256 を作る"""
+    h = hashlib.sha256()
+    for part in contents if isinstance(contents, (list, tuple)) else [contents]:
+        if isinstance(part, str):
+            h.update(b"s" + part.encode("utf-8"))
+        elif isinstance(part, (bytes, bytearray)):
+            h.update(b"b" + bytes(part))
+        elif isinstance(part, dict) and isinstance(part.get("data"), bytes):
+            h.update(f"d{part.get('mime_type')}".encode())
+            h.update(part["data"])
+        elif hasattr(part, "tobytes"):
+            h.update(f"i{part.mode}{part.size}".encode())
+            h.update(part.tobytes())
+        else:
+            h.update(b"j" + json.dumps(part, sort_keys=True, default=str).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _evict(conn, now):
+    conn.execute("DELETE FROM responses WHERE created < ?", (now - LLM_CACHE_TTL,))
+    conn.execute("""
+        DELETE FROM responses WHERE key IN (
+            SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?
+        )
+    """, (LLM_CACHE_MAX_ENTRIES,))
+
+
+def _get(key, now):
+    with _lock:
+        conn = _connect()
+        row = conn.execute(
+            "SELECT response FROM responses WHERE key = ? AND created >= ?",
+            (key, now - LLM_CACHE_TTL),
+        ).fetchone()
+        if row is None:
+            metrics.inc("llm_cache_requests_total", result="miss")
+            return None
+        conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        conn.commit()
+        metrics.inc("llm_cache_requests_total", result="hit")
+        return row[0]
+
+
+def _put(key, model_name, version, text, now):
+    global _puts
+    with _lock:
+        conn = _connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model_name, version, text, now, now),
+        )
+        _puts += 1
+        if _puts % 100 == 1:
+            _evict(conn, now)
+        conn.commit()
+
+
+def _make_key(model_name, version, contents, kwargs):
+    return hashlib.sha256(
+        f"{model_name}\0{version}\0{_digest(contents)}\0{json.dumps(kwargs, sort_keys=True, default=str)}".encode()
+    ).hexdigest()
+
+
+def get_answer(model, version, contents):
+    """put_answer で保存した回答を返す（なければ None）"""
+    key = _make_key(getattr(model, "model_name", ""), version, contents, {})
+    try:
+        return _get(key, time.time())
+    except sqlite3.Error as e:
+        logging.warning(f"⚠️ LLMキャッシュ読込失敗: {e}")
+        return None
+
+
+def put_answer(model, version, contents, answer):
+    """
+    応答の一部（まとめて問い合わせた中の 1 行分の回答など）を contents の回答として保存する。
+    次回からは同じ contents なら get_answer で取り出せる。
+    """
+    model_name = getattr(model, "model_name", "")
+    key = _make_key(model_name, version, contents, {})
+    try:
+        _put(key, model_name, version, answer, time.time())
+    except sqlite3.Error as e:
+        logging.warning(f"⚠️ LLMキャッシュ保存失敗: {e}")
+
+
+def generate_text(model, contents, version, **kwargs):
+    """
+    model.generate_content(contents) の応答テキストを返す（キャッシュ付き）。
+    例外はキャッシュせず、そのまま呼び出し側に伝える。
+    """
+    model_name = getattr(model, "model_name", "")
+    key = _make_key(model_name, version, contents, kwargs)
+
+    # 同じ入力の同時呼び出しは 1 回にまとめ、後続はキャッシュから返す
+    with _key_locks.hold(key):
+        try:
+            cached = _get(key, time.time())
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ LLMキャッシュ読込失敗: {e}")
+            cached = None
+        if cached is not None:
+            return cached
+
+        response = gemini_client.generate(model, contents, version, **kwargs)
+        text = response.text
+
+        try:
+            _put(key, model_name, version, text, time.time())
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ LLMキャッシュ保存失敗: {e}")
+        return text
@@ -1,43 +1,197 @@
-from flask import Flask
-import pandas as pd
-import gspread
-from gspread_dataframe import get_as_dataframe
-from google.oauth2 import service_account
+from flask import Flask, Response, jsonify, request
 import logging
+import json
+import os
+import time
 
-from read_sheet import read_sheet
-from update_組織名 import update_組織名T
-from update_組織名 import update_組織名G
-from update_組織名 import update_組織名
-from update_組織名 import update_証券番号
-from update_価値ある活動 import update_バリューT
-from update_価値ある活動 import update_バリューG
-from update_価値ある活動 import update_バリュー
+import metrics
+from read_sheet import open_worksheet, reset_worksheet, is_connection_error
+from read_sheet import SPREADSHEET_ID, WORKSHEET_NAME
+import jobs
+from sheet_io import load_sheet_df
+from run_budget import start_run, end_run
 
 
 # Cloud Logging に出力するよう設定
 logging.basicConfig(level=logging.INFO)
 
+# dag     : シートを 1 回読み、行ごとに入力が揃った処理から順に実行する（row_dag.py）
+# pipeline: シートを 1 回読み、ステージごとに全行を処理してから次のステージへ進む
+# legacy  : ステージごとに読み込み・書き込みを行う（従来方式）
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "dag")
+
+# end  : 全ステージ終了後に 1 回だけ書き込む
+# stage: ステージ終了ごとに変更セルを書き込む（途中で落ちても結果が残る）
+SHEET_CHECKPOINT = os.getenv("SHEET_CHECKPOINT", "end")
+
 app = Flask(__name__)
 
+
+# -------------------------------
+# ステージの読み込み
+# -------------------------------
+# ステージのモジュールは pandas・Gemini・PDF ライブラリを読み込むため、
+# 起動時ではなく最初の実行時に import する（Cloud Run のコールドスタートを短くする）。
+def stages():
+    from update_組織名 import update_組織名T
+    from update_組織名 import update_組織名G
+    from update_組織名 import update_組織名
+    from update_組織名 import update_証券番号
+    from update_価値ある活動 import update_バリューT
+    from update_価値ある活動 import update_バリューG
+    from update_価値ある活動 import update_バリュー
+
+    return [
+        update_組織名T,
+        update_組織名G,
+        update_組織名,
+        update_証券番号,
+        update_バリューT,
+        update_バリューG,
+        update_バリュー,
+    ]
+
+
+def sheet_columns():
+    """パイプライン全体でシートから読む列（各ステージの入力・出力列の和）"""
+    import update_組織名
+    import update_価値ある活動
+
+    return list(dict.fromkeys(update_組織名.SHEET_COLUMNS + update_価値ある活動.SHEET_COLUMNS))
+
+
+def _run_stages(worksheet, df, run, job):
+    for stage in stages():
+        # 予算切れ後に後続ステージを走らせると、未処理の空欄が「対象外」扱いになるため止める
+        if run.expired():
+            logging.warning(f"⏰ 実行時間の予算切れ: {stage.__name__} 以降は次回に持ち越し")
+            break
+
+        name = stage.__name__
+        # ステージが書き込んだセル数（row_done の回数）。行単位スケジューラと同じ数え方
+        before = run.processed
+        if job is not None:
+            job.stage_started(name)
+            run.on_tick = lambda: job.stage_progress(name, run.processed - before)
+
+        stage_started = time.monotonic()
+        try:
+            stage(worksheet, df)
+        except Exception as e:
+            if job is not None:
+                job.stage_finished(name, run.processed - before, error=e)
+            raise
+        finally:
+            metrics.inc("pipeline_stage_rows_total", run.processed - before, stage=name)
+            metrics.observe("pipeline_stage_seconds", time.monotonic() - stage_started, stage=name)
+
+        if job is not None:
+            job.stage_finished(name, run.processed - before)
+        if SHEET_CHECKPOINT == "stage":
+            run.flush()
+
+
+def _load(worksheet):
+    """必要な列だけ読む。使い回している接続が切れていれば開き直して 1 回だけやり直す"""
+    columns = sheet_columns()
+    try:
+        return worksheet, load_sheet_df(worksheet, columns)
+    except Exception as e:
+        if not is_connection_error(e):
+            raise
+        logging.warning(f"🔌 シートを開き直して再試行: {e}")
+        worksheet = open_worksheet(refresh=True)
+        return worksheet, load_sheet_df(worksheet, columns)
+
+
+def run_pipeline(worksheet, job=None):
+    baseline = metrics.snapshot()
+    started = time.monotonic()
+    worksheet, df = _load(worksheet)
+    run = start_run(worksheet, df)
+
+    error = None
+    try:
+        if PIPELINE_MODE == "dag":
+            from row_dag import run_dag
+
+            run_dag(df, job)
+        else:
+            _run_stages(worksheet, df, run, job)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        try:
+            end_run()
+        except Exception as e:
+            # 実行中の例外があればそちらを伝える
+            if error is None:
+                raise
+            logging.error(f"❌ 最後のシート書き込みに失敗: {e}")
+        finally:
+            # 実行 1 回分の計測値の増分を 1 行の JSON で出す（最後の書き込みに失敗しても出す）
+            summary = {"seconds": round(time.monotonic() - started, 1), **metrics.summary_since(baseline)}
+            if job is not None:
+                job.summary = summary
+            logging.info("📊 実行サマリー: " + json.dumps(summary, ensure_ascii=False))
+
+
+def pipeline_job(job):
+    try:
+        run_pipeline(open_worksheet(), job)
+    except Exception as e:
+        # 途中の書き込みで接続が切れた場合も、次のリクエストでは開き直す
+        if is_connection_error(e):
+            reset_worksheet()
+        raise
+
+
+# 同じシートに対する実行は同時に 1 つだけ
+SHEET_KEY = f"{SPREADSHEET_ID}/{WORKSHEET_NAME}"
+
+
 @app.route('/', methods=['GET', 'POST'])
 def main():
     logging.info('📥 リクエスト受信')
 
-    # スプレッドシート読込
-    worksheet, existing_df, processed_urls = read_sheet()
-
-    update_組織名T(worksheet)
-    update_組織名G(worksheet)
-    update_組織名(worksheet)    
-    update_証券番号(worksheet)
-    update_バリューT(worksheet)
-    update_バリューG(worksheet)
-    update_バリュー(worksheet)
-    
+    if PIPELINE_MODE == "legacy":
+        worksheet = open_worksheet()
+
+        for stage in stages():
+            stage(worksheet)
+
+        return 'Cloud Run Function executed.', 200
+
+    # POST: ジョブとして受け付けてすぐ返す（進捗は GET /jobs/<id>）
+    if request.method == 'POST':
+        job, created = jobs.submit(SHEET_KEY, pipeline_job)
+        status = 202 if created else 409
+        return jsonify({"job_id": job.id, "status": job.status}), status
+
+    # GET: 従来どおり同期実行（実行中のジョブがあれば重複させない）
+    job = jobs.run_exclusive(SHEET_KEY, pipeline_job)
+    if job is None:
+        return 'すでに実行中です', 409
+    if job.status == "failed":
+        return f'エラー: {job.errors[-1]}', 500
+
     return 'Cloud Run Function executed.', 200
 
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "not found"}), 404
+    return jsonify(job.to_dict()), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     logging.info('🚀 アプリ起動')
     app.run(host='0.0.0.0', port=8080)
@@ -0,0 +1,127 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+# -------------------------------
+# 計測値（Prometheus テキスト形式で /metrics に出す）
+# -------------------------------
+# 外部ライブラリは使わず、カウンターとヒストグラムだけを持つ簡易実装。
+SECONDS_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120]
+BYTES_BUCKETS = [1e4, 1e5, 1e6, 5e6, 1e7, 2e7, 5e7, 1e8]
+
+# 名前 → (種類, 説明, バケット)
+DEFINITIONS = {
+    "pipeline_stage_rows_total": ("counter", "ステージで処理した行数", None),
+    "pipeline_stage_seconds": ("histogram", "ステージの所要時間", SECONDS_BUCKETS),
+    "pipeline_task_seconds": ("histogram", "行単位スケジューラでの 1 件の処理の所要時間", SECONDS_BUCKETS),
+    "dedup_rows_total": ("counter", "同じ入力の行をまとめて処理を省いた行数", None),
+    "pdf_cache_requests_total": ("counter", "PDF キャッシュの参照回数（result=hit/miss）", None),
+    "pdf_download_bytes_total": ("counter", "PDF ダウンロード量", None),
+    "pdf_download_size_bytes": ("histogram", "1 回のダウンロードのサイズ", BYTES_BUCKETS),
+    "pdf_download_seconds": ("histogram", "1 回のダウンロードの所要時間", SECONDS_BUCKETS),
+    "pdf_revalidations_total": ("counter", "条件付き GET による再確認（result=not_modified/changed/error）", None),
+    "http_retries_total": ("counter", "HTTP 再試行回数", None),
+    "pdf_range_saved_bytes_total": ("counter", "部分取得で節約したバイト数", None),
+    "pdf_parse_seconds": ("histogram", "PDF テキスト抽出の所要時間", SECONDS_BUCKETS),
+    "pdf_render_seconds": ("histogram", "PDF 画像化の所要時間", SECONDS_BUCKETS),
+    "pdf_task_timeouts_total": ("counter", "PDF 解析・画像化の時間切れ（kind=parse/render）", None),
+    "page_select_total": ("counter", "バリュー用ページ選択（result=hit/fallback）", None),
+    "gemini_requests_total": ("counter", "Gemini 呼び出し回数", None),
+    "gemini_request_seconds": ("histogram", "Gemini 呼び出しの所要時間", SECONDS_BUCKETS),
+    "gemini_retries_total": ("counter", "Gemini 再試行回数", None),
+    "gemini_throttled_total": ("counter", "Gemini の 429（RESOURCE_EXHAUSTED）回数", None),
+    "gemini_tokens_total": ("counter", "Gemini のトークン数（direction=input/output）", None),
+    "llm_cache_requests_total": ("counter", "LLM キャッシュの参照回数（result=hit/miss）", None),
+    "sheet_api_calls_total": ("counter", "Sheets API 呼び出し回数", None),
+    "memory_throttled_total": ("counter", "メモリ予算超過で重い処理の着手を待たせた回数", None),
+    "memory_wait_seconds": ("histogram", "メモリ予算超過で待った秒数", SECONDS_BUCKETS),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    buckets = DEFINITIONS[name][2]
+    with _lock:
+        key = _key(name, labels)
+        hist = _histograms.setdefault(key, {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                hist["buckets"][i] += 1
+        hist["sum"] += value
+        hist["count"] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - started, **labels)
+
+
+def _labels(pairs, extra=()):
+    pairs = list(pairs) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render():
+    """Prometheus テキスト形式で全計測値を返す"""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: {**v, "buckets": list(v["buckets"])} for k, v in _histograms.items()}
+
+    lines = []
+    for name, (kind, help_text, buckets) in DEFINITIONS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+        else:
+            for (n, labels), hist in sorted(histograms.items()):
+                if n != name:
+                    continue
+                for bound, count in zip(buckets, hist["buckets"]):
+                    lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{name}_sum{_labels(labels)} {hist['sum']}")
+                lines.append(f"{name}_count{_labels(labels)} {hist['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def snapshot():
+    """{"名前{ラベル}": 値} の平坦な辞書（ヒストグラムは _sum と _count のみ）"""
+    with _lock:
+        flat = {f"{n}{_labels(l)}": v for (n, l), v in _counters.items()}
+        for (n, l), hist in _histograms.items():
+            flat[f"{n}_sum{_labels(l)}"] = hist["sum"]
+            flat[f"{n}_count{_labels(l)}"] = hist["count"]
+    return flat
+
+
+def summary_since(before):
+    """snapshot() からの増分（実行 1 回分のサマリー）"""
+    summary = {}
+    for key, value in snapshot().items():
+        delta = value - before.get(key, 0)
+        if delta:
+            summary[key] = round(delta, 3) if isinstance(delta, float) else delta
+    return summary
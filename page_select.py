@@ -0,0 +1,81 @@
+import logging
+import os
+import re
+import unicodedata
+
+import metrics
+
+
+# -------------------------------
+# ページ選択（バリュー系ステージ）
+# -------------------------------
+# 統合報告書のバリュー・行動指針のページは 12〜25 ページ目にあることが多く、
+# 先頭 10 ページは表紙と目次が中心になる。テキスト層をキーワードで採点し、
+# 点数の高いページだけを Gemini に送る（画像版はそのページだけを画像化する）。
+# VALUE_SCAN_PAGES     : 採点する先頭ページ数
+# VALUE_TOP_PAGES      : 採点上位から使うページ数
+# VALUE_FALLBACK_PAGES : キーワードが見つからない・テキスト層がないときに使う先頭ページ数（従来どおり）
+VALUE_SCAN_PAGES = int(os.getenv("VALUE_SCAN_PAGES", "30"))
+VALUE_TOP_PAGES = int(os.getenv("VALUE_TOP_PAGES", "4"))
+VALUE_FALLBACK_PAGES = int(os.getenv("VALUE_FALLBACK_PAGES", "10"))
+
+# キーワード → 重み（正規化後の小文字・空白なしで照合する）
+VALUE_KEYWORDS = {
+    "バリュー": 3,
+    "行動指針": 3,
+    "価値観": 3,
+    "行動規範": 3,
+    "values": 3,
+    "ourvalue": 2,
+    "大切にする": 1,
+    "理念": 1,
+    "ミッション": 1,
+    "ビジョン": 1,
+}
+# 1 つのキーワードを数える上限（本文中で何度も出る語に引っ張られない）
+KEYWORD_MAX_COUNT = 5
+# 目次のページは全見出しを含むので点数を下げる
+TOC_PATTERN = re.compile(r"目次|contents")
+TOC_FACTOR = 0.5
+# 最高点のこの割合に届かないページは、上位 k に入っても使わない
+MIN_SCORE_RATIO = 0.25
+
+_SPACES = re.compile(r"\s+")
+
+
+def _normalize(text):
+    # pypdf は和文の文字間に空白や改行を挟むことがあるので取り除いてから照合する
+    return _SPACES.sub("", unicodedata.normalize("NFKC", text)).lower()
+
+
+def score_page(text, keywords=VALUE_KEYWORDS):
+    norm = _normalize(text)
+    score = sum(weight * min(norm.count(word), KEYWORD_MAX_COUNT) for word, weight in keywords.items())
+    if TOC_PATTERN.search(norm):
+        score *= TOC_FACTOR
+    return score
+
+
+def rank_pages(page_texts, k, keywords=VALUE_KEYWORDS):
+    """点数の高いページの番号（0 始まり・昇順）を最大 k 件返す。キーワードがなければ空"""
+    scored = [(score_page(text, keywords), i) for i, text in enumerate(page_texts) if text]
+    best = max((s for s, _ in scored), default=0)
+    if best <= 0:
+        return []
+    top = sorted((s for s in scored if s[0] >= best * MIN_SCORE_RATIO), key=lambda s: (-s[0], s[1]))[:k]
+    return sorted(i for _, i in top)
+
+
+def value_pages(page_texts):
+    """
+    バリュー抽出に使うページ番号（0 始まり）を返す。
+    キーワードが見つからなければ先頭 VALUE_FALLBACK_PAGES ページにする。
+    """
+    selected = rank_pages(page_texts or [], VALUE_TOP_PAGES)
+    if selected:
+        metrics.inc("page_select_total", result="hit")
+        logging.info(f"🔎 ページ選択: {[i + 1 for i in selected]} ページ目")
+        return selected
+
+    metrics.inc("page_select_total", result="fallback")
+    return list(range(VALUE_FALLBACK_PAGES))
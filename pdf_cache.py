@@ -0,0 +1,525 @@
+import logging
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+import http_client
+import metrics
+from executor import KeyedLocks
+
+
+# -------------------------------
+# PDF ダウンロードキャッシュ（全ステージ共通）
+# -------------------------------
+# URL → 内容ハッシュ(sha256) の索引と、ハッシュ名で保存した PDF 本体からなる
+# ディスクキャッシュ。同じ PDF を別 URL から取得した場合も本体は 1 つだけ持つ。
+# 容量上限を超えたら最終利用時刻（mtime）の古いものから削除する（LRU）。容量にはページ画像も含む。
+# Cloud Run の /tmp はメモリ上にあるため、上限は控えめにしておくこと。
+# 索引には ETag / Last-Modified も持ち、最終確認から PDF_REVALIDATE_AFTER 秒経った URL は
+# 条件付き GET で確認する（変わっていなければ 304 で本体は再取得しない）。
+# 本体はダウンロードしながら一時ファイル（*.part）に書き出し、ハッシュ名に付け替えて保存する。
+# 解析・画像化はキャッシュ上のファイルを直接読み、PDF 全体を bytes としてメモリに載せない。
+# 渡したファイルは使い終わるまで（release_pdf / ファイルを閉じるまで）削除しない。
+CACHE_DIR = os.getenv("PDF_CACHE_DIR", "/tmp/pdf_cache")
+CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+PDF_REVALIDATE_AFTER = float(os.getenv("PDF_REVALIDATE_AFTER", str(24 * 3600)))
+
+# 部分取得（HTTP Range）の設定。先頭数ページしか読まないステージ向け
+# カスケードモードでなければ同じ PDF を画像版（G）が必ず全体取得するので、部分取得すると
+# 通信量・リクエスト数が増えるだけになる。既定ではカスケードモードのときだけ有効にする
+PDF_RANGE_FETCH = os.getenv("PDF_RANGE_FETCH", os.getenv("CASCADE_MODE", "0")) == "1"
+PDF_RANGE_BLOCK = int(os.getenv("PDF_RANGE_BLOCK", str(256 * 1024)))
+# 部分取得した URL は本体なしで（ETag などだけ）索引に残る。索引を保存するたびに、
+# 最終確認から PDF_INDEX_RANGE_TTL 秒経ったものを消し、新しい順に PDF_INDEX_RANGE_MAX 件まで残す
+PDF_INDEX_RANGE_TTL = float(os.getenv("PDF_INDEX_RANGE_TTL", str(7 * 24 * 3600)))
+PDF_INDEX_RANGE_MAX = int(os.getenv("PDF_INDEX_RANGE_MAX", "5000"))
+
+_index = None
+_index_lock = threading.Lock()
+_url_locks = KeyedLocks(reentrant=True)
+_pins = {}  # 内容ハッシュ → 使用中の数（_index_lock で保護）
+
+
+def _index_path():
+    return os.path.join(CACHE_DIR, "index.json")
+
+
+def _blob_path(digest):
+    return os.path.join(CACHE_DIR, f"{digest}.pdf")
+
+
+def _load_index():
+    global _index
+    if _index is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        try:
+            with open(_index_path(), encoding="utf-8") as f:
+                _index = json.load(f)
+        except (OSError, ValueError):
+            _index = {}
+        # 旧形式（URL → ハッシュ文字列）の索引も読めるようにする
+        for url, entry in list(_index.items()):
+            if isinstance(entry, str):
+                _index[url] = {"digest": entry}
+        # 前回のプロセスが書きかけで終わった一時ファイルを消す
+        for name in os.listdir(CACHE_DIR):
+            if name.endswith(".part"):
+                _remove(os.path.join(CACHE_DIR, name))
+    return _index
+
+
+def _prune_index():
+    """本体を持たない索引エントリ（部分取得の記録）を古い順に消す（_index_lock 保持中に呼ぶ）"""
+    now = time.time()
+    unstored = sorted(
+        ((entry.get("checked", 0), url) for url, entry in _index.items() if not entry.get("digest")),
+        reverse=True,
+    )
+    for n, (checked, url) in enumerate(unstored):
+        if n >= PDF_INDEX_RANGE_MAX or now - checked > PDF_INDEX_RANGE_TTL:
+            del _index[url]
+
+
+def _save_index():
+    _prune_index()
+    tmp = _index_path() + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(_index, f, ensure_ascii=False)
+    os.replace(tmp, _index_path())
+
+
+def pages_dir(digest):
+    """PDF ごとのページ画像置き場（本体と一緒に削除される）"""
+    return os.path.join(CACHE_DIR, f"{digest}.pages")
+
+
+def text_path(url):
+    """URL ごとのテキスト抽出結果の置き場（容量上限の対象に含む）"""
+    return os.path.join(CACHE_DIR, f"{hashlib.sha256(url.encode()).hexdigest()}.text.json")
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _pin(digest):
+    """_index_lock 保持中に呼ぶ"""
+    _pins[digest] = _pins.get(digest, 0) + 1
+
+
+def release_pdf(path):
+    """fetch_pdf_file で受け取ったファイルを使い終わったら呼ぶ（キャッシュの削除対象に戻す）"""
+    digest = digest_of(path)
+    with _index_lock:
+        count = _pins.get(digest, 0) - 1
+        if count > 0:
+            _pins[digest] = count
+        else:
+            _pins.pop(digest, None)
+
+
+class _PinnedFile(io.FileIO):
+    """閉じたときに release_pdf する読み取り用ファイル（open_pdf_stream が返す）"""
+
+    def close(self):
+        if not self.closed:
+            release_pdf(self.name)
+        super().close()
+
+
+def _open_pinned(path):
+    """使用中にしたキャッシュ上の PDF を開く。閉じると使用中が解除される"""
+    return io.BufferedReader(_PinnedFile(path))
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _evict(keep=None):
+    """
+    容量上限を超えた分を古い順に削除する（_index_lock 保持中に呼ぶ）。
+    容量には PDF 本体・テキスト抽出結果・ページ画像を含め、PDF はそのページ画像と一緒に削除する。
+    keep のハッシュと、解析・画像化で使用中の PDF（とそのページ画像）は残す。
+    """
+    total = 0
+    files = []
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if name.endswith(".pages"):
+            # 本体があればその PDF と一緒に数える。本体のないページ画像はそれだけで削除対象
+            digest = name[:-len(".pages")]
+            if os.path.exists(_blob_path(digest)):
+                continue
+            size = _dir_size(path)
+        elif name.endswith((".pdf", ".text.json")):
+            digest = name[:-len(".pdf")] if name.endswith(".pdf") else None
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            size = st.st_size + (_dir_size(pages_dir(digest)) if digest else 0)
+        else:
+            continue
+
+        total += size
+        if digest is not None and (digest == keep or digest in _pins):
+            continue
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        files.append((mtime, size, name, path))
+
+    if total <= CACHE_MAX_BYTES:
+        return
+
+    removed = set()
+    count = 0
+    for _, size, name, path in sorted(files):
+        if total <= CACHE_MAX_BYTES:
+            break
+        if name.endswith(".pages"):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            if name.endswith(".pdf"):
+                digest = name[:-len(".pdf")]
+                shutil.rmtree(pages_dir(digest), ignore_errors=True)
+                removed.add(digest)
+        total -= size
+        count += 1
+
+    for url in [u for u, e in _index.items() if e.get("digest") in removed]:
+        del _index[url]
+    logging.info(f"🧹 PDFキャッシュ削除: {count} 件")
+
+
+def is_cached(url):
+    """URL の PDF 本体またはテキスト抽出結果がキャッシュにあれば True"""
+    with _index_lock:
+        if url in _load_index():
+            return True
+    return os.path.exists(text_path(url))
+
+
+def cached_first(task):
+    """run_rows の key 用。ダウンロード済みの URL を先に処理する（予算内に終わる行を増やす）"""
+    idx, args = task
+    return (not is_cached(args[0]), idx)
+
+
+def cached_digest(url):
+    """URL の PDF 本体がキャッシュにあればその内容ハッシュ、なければ None"""
+    with _index_lock:
+        return _load_index().get(url, {}).get("digest")
+
+
+def digest_of(path):
+    """キャッシュ上の PDF のパスから内容ハッシュを返す"""
+    return os.path.basename(path)[:-len(".pdf")]
+
+
+def _cached_path(url):
+    """キャッシュ済みなら使用中にしてパスを返す（使い終わったら release_pdf）"""
+    with _index_lock:
+        digest = _load_index().get(url, {}).get("digest")
+        if not digest:
+            return None
+
+        path = _blob_path(digest)
+        try:
+            os.utime(path)  # LRU 用に最終利用時刻を更新
+        except OSError:
+            return None
+        _pin(digest)
+        return path
+
+
+def _validators(res):
+    return {
+        "etag": res.headers.get("ETag"),
+        "last_modified": res.headers.get("Last-Modified"),
+        "checked": time.time(),
+    }
+
+
+def _remember(url, res, digest=None):
+    """本体を保存しない取得（部分取得）でも、次回の再確認用に ETag などを残す"""
+    with _index_lock:
+        _load_index()[url] = {"digest": digest, **_validators(res)}
+        _save_index()
+
+
+def _download(url, timeout, kind, headers=None):
+    """
+    本体を一時ファイルに書き出して (レスポンス, 一時ファイルのパス, sha256) を返す。
+    200 / 206 以外なら一時ファイルは残さず、パスは None。
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = os.path.join(CACHE_DIR, f".{uuid.uuid4().hex}.part")
+    try:
+        res, digest = http_client.download(url, timeout, kind, tmp, headers)
+    except Exception:
+        _remove(tmp)
+        raise
+
+    if res.status_code not in (200, 206):
+        _remove(tmp)
+        return res, None, ""
+    return res, tmp, digest
+
+
+def _store_file(url, tmp, digest, res, pin=False):
+    """
+    ダウンロードした一時ファイルをハッシュ名で保存し、保存先のパスを返す。
+    pin=True なら使用中にしてから返す（使い終わったら release_pdf）
+    """
+    path = _blob_path(digest)
+
+    with _index_lock:
+        index = _load_index()
+        if not os.path.exists(path):
+            os.replace(tmp, path)
+        else:
+            _remove(tmp)
+            os.utime(path)
+        index[url] = {"digest": digest, **_validators(res)}
+        if pin:
+            _pin(digest)
+        _evict(keep=digest)
+        _save_index()
+    return path
+
+
+def revalidate(url, timeout=20):
+    """
+    最終確認から PDF_REVALIDATE_AFTER 秒以上経ったキャッシュを条件付き GET で確認する。
+    304 なら確認時刻だけ更新し、200 なら本体を置き換えて古いテキスト抽出結果を捨てる。
+    ETag / Last-Modified を持っていない、または確認に失敗した場合は手元のキャッシュをそのまま使う。
+    """
+    with _url_locks.hold(url):
+        with _index_lock:
+            entry = dict(_load_index().get(url) or {})
+        if not entry or time.time() - entry.get("checked", 0) < PDF_REVALIDATE_AFTER:
+            return
+
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        if not headers:
+            return
+
+        try:
+            res, tmp, digest = _download(url, timeout, "revalidate", headers)
+        except Exception as e:
+            logging.warning(f"⚠️ 再確認失敗（キャッシュを使用）{e}: {url}")
+            metrics.inc("pdf_revalidations_total", result="error")
+            return
+
+        if res.status_code == 304:
+            with _index_lock:
+                if url in _load_index():
+                    _index[url]["checked"] = time.time()
+                    _save_index()
+            metrics.inc("pdf_revalidations_total", result="not_modified")
+        elif res.status_code == 200:
+            logging.info(f"🔄 PDF更新を検出: {url}")
+            _store_file(url, tmp, digest, res)
+            _remove(text_path(url))
+            metrics.inc("pdf_revalidations_total", result="changed")
+        else:
+            if tmp is not None:
+                _remove(tmp)
+            logging.warning(f"⚠️ 再確認失敗（キャッシュを使用）{res.status_code}: {url}")
+            metrics.inc("pdf_revalidations_total", result="error")
+
+
+def fetch_pdf_file(url, timeout=20):
+    """
+    URL の PDF をキャッシュに置き、(ステータスコード, ファイルパス) を返す。
+    キャッシュ済みなら通信しない。200 以外のパスは None。
+    返したファイルは使用中になり削除されないので、使い終わったら release_pdf(パス) を呼ぶこと。
+    """
+    with _url_locks.hold(url):
+        revalidate(url, timeout)
+        cached = _cached_path(url)
+        if cached is not None:
+            logging.info(f"📦 PDFキャッシュ利用: {url}")
+            metrics.inc("pdf_cache_requests_total", result="hit")
+            return 200, cached
+
+        metrics.inc("pdf_cache_requests_total", result="miss")
+        res, tmp, digest = _download(url, timeout, "full")
+        if res.status_code != 200:
+            if tmp is not None:
+                _remove(tmp)
+            return res.status_code, None
+        return 200, _store_file(url, tmp, digest, res, pin=True)
+
+
+def _read_and_remove(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    _remove(path)
+    return data
+
+
+# ============================================================
+#  部分取得（HTTP Range）
+# ============================================================
+class RangeFile:
+    """
+    Range リクエストで必要なブロックだけを取得する読み取り専用ファイル。
+    サーバーが途中で Range を無視した場合は全体をキャッシュに保存してそのファイルを読む。
+    """
+
+    def __init__(self, url, size, timeout, first_block, validator=None):
+        self.url = url
+        self.size = size
+        self.timeout = timeout
+        # 途中で PDF が差し替わったらブロックが混ざらないよう、If-Range で全体を受け取る
+        self.validator = validator
+        self.pos = 0
+        self.fetched = len(first_block)
+        self._blocks = {0: first_block}
+        self._full = None
+
+    def _fetch(self, block_no):
+        start = block_no * PDF_RANGE_BLOCK
+        end = min(start + PDF_RANGE_BLOCK, self.size) - 1
+        headers = {"Range": f"bytes={start}-{end}"}
+        if self.validator:
+            headers["If-Range"] = self.validator
+
+        res, tmp, digest = _download(self.url, self.timeout, "range", headers)
+
+        if res.status_code == 206:
+            body = _read_and_remove(tmp)
+            self.fetched += len(body)
+            self._blocks[block_no] = body
+        elif res.status_code == 200:
+            path = _store_file(self.url, tmp, digest, res, pin=True)
+            self._full = _open_pinned(path)
+            self.size = os.path.getsize(path)
+            self.fetched += self.size
+            self._blocks.clear()
+        else:
+            raise OSError(f"Range 取得失敗 {res.status_code}: {self.url}")
+
+    def read(self, n=-1):
+        end = self.size if n is None or n < 0 else min(self.pos + n, self.size)
+        if self._full is not None:
+            self._full.seek(self.pos)
+            data = self._full.read(max(0, end - self.pos))
+            self.pos += len(data)
+            return data
+
+        chunks = []
+        while self.pos < end:
+            block_no, offset = divmod(self.pos, PDF_RANGE_BLOCK)
+            if block_no not in self._blocks:
+                self._fetch(block_no)
+                if self._full is not None:
+                    return b"".join(chunks) + self.read(end - self.pos)
+            piece = self._blocks[block_no][offset:offset + end - self.pos]
+            if not piece:
+                break
+            chunks.append(piece)
+            self.pos += len(piece)
+        return b"".join(chunks)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(0, min(offset, self.size))
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if self._full is not None:
+            self._full.close()
+        saved = max(0, self.size - self.fetched)
+        metrics.inc("pdf_range_saved_bytes_total", saved)
+        logging.info(f"📉 部分取得: {self.fetched}/{self.size} bytes（{saved} bytes 節約）: {self.url}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_pdf_stream(url, timeout=20):
+    """
+    先頭数ページだけ読むステージ用。(ステータスコード, ファイルオブジェクト) を返す（呼び出し側で閉じる）。
+    キャッシュ済みならそのファイル、サーバーが Range に対応していれば RangeFile、
+    そうでなければ全体を取得（キャッシュにも保存）してそのファイルを返す。
+    """
+    if not PDF_RANGE_FETCH:
+        status, path = fetch_pdf_file(url, timeout=timeout)
+        return status, _open_pinned(path) if path is not None else None
+
+    with _url_locks.hold(url):
+        revalidate(url, timeout)
+        cached = _cached_path(url)
+        if cached is not None:
+            logging.info(f"📦 PDFキャッシュ利用: {url}")
+            metrics.inc("pdf_cache_requests_total", result="hit")
+            return 200, _open_pinned(cached)
+
+        metrics.inc("pdf_cache_requests_total", result="miss")
+        headers = {"Range": f"bytes=0-{PDF_RANGE_BLOCK - 1}"}
+        res, tmp, digest = _download(url, timeout, "range", headers)
+
+        if res.status_code == 206:
+            m = re.search(r"/(\d+)$", res.headers.get("Content-Range", ""))
+            if m and int(m.group(1)) > os.path.getsize(tmp):
+                content = _read_and_remove(tmp)
+                _remember(url, res)
+                # 弱い ETag（W/...）は If-Range に使えない
+                etag = res.headers.get("ETag", "")
+                validator = etag if etag and not etag.startswith("W/") else res.headers.get("Last-Modified")
+                return 200, RangeFile(url, int(m.group(1)), timeout, content, validator)
+            if not m:
+                # 全体サイズが分からない → 通常の全体取得に切り替える
+                _remove(tmp)
+                status, path = fetch_pdf_file(url, timeout=timeout)
+                return status, _open_pinned(path) if path is not None else None
+
+        elif res.status_code != 200:
+            return res.status_code, None
+
+        # Range 非対応、または 1 ブロックに収まる小さい PDF → 全体が手元にある
+        return 200, _open_pinned(_store_file(url, tmp, digest, res, pin=True))
@@ -0,0 +1,144 @@
+import logging
+import json
+import os
+import re
+import shutil
+
+import metrics
+from executor import KeyedLocks, memory_slot
+from pdf_cache import digest_of, pages_dir
+from pdf_workers import PDF_TASK_TIMEOUT
+
+
+# -------------------------------
+# PDF ページ画像化（画像系ステージ共通）
+# -------------------------------
+# 1 つの PDF につき描画したページを 1 枚ずつ JPEG でキャッシュし、
+# 組織名G（先頭 3 ページ）とバリューG（ページ選択で選んだページ）で使い回す。
+# まだ描画していないページだけを、連続する範囲ごとにまとめて描画する。
+# 画像は長辺 RENDER_MAX_EDGE px に縮小した JPEG のまま Gemini に渡す
+# （PIL 画像で渡すと可逆 WebP に再エンコードされて重い）。
+RENDER_DPI = int(os.getenv("RENDER_DPI", "150"))
+RENDER_MAX_EDGE = int(os.getenv("RENDER_MAX_EDGE", "1600"))
+RENDER_JPEG_QUALITY = int(os.getenv("RENDER_JPEG_QUALITY", "80"))
+RENDER_GRAYSCALE = os.getenv("RENDER_GRAYSCALE", "0") == "1"
+RENDER_THREADS = int(os.getenv("RENDER_THREADS", "4"))
+# pdftoppm は別プロセスで動くので、1 件の上限秒数（PDF_TASK_TIMEOUT）を超えたら pdf2image がそれを止める
+
+# pdftoppm の出力ファイル名（<prefix>-<ページ番号>.jpg）からページ番号を取り出す
+_PAGE_FILE = re.compile(r"-(\d+)\.jpg$")
+
+_locks = KeyedLocks()
+
+
+def _render_dir(digest):
+    tag = f"{RENDER_MAX_EDGE}px-q{RENDER_JPEG_QUALITY}-{'gray' if RENDER_GRAYSCALE else 'rgb'}"
+    return os.path.join(pages_dir(digest), tag)
+
+
+def _load_manifest(path):
+    """{"files": {ページ番号(文字列): ファイル名}, "page_count": 総ページ数（不明なら None）}"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if "files" in manifest and isinstance(manifest["files"], dict) else None
+
+
+def _runs(numbers):
+    """昇順のページ番号を連続する範囲 [(first, last), ...] にまとめる"""
+    runs = []
+    for n in numbers:
+        if runs and runs[-1][1] == n - 1:
+            runs[-1][1] = n
+        else:
+            runs.append([n, n])
+    return runs
+
+
+def _render(pdf_path, out_dir, first_page, last_page):
+    """first_page〜last_page を描画して {ページ番号: ファイル名} を返す（PDF の末尾で打ち切られる）"""
+    from pdf2image import convert_from_path
+    from pdf2image.exceptions import PDFPopplerTimeoutError
+
+    with memory_slot(), metrics.timer("pdf_render_seconds"):
+        try:
+            paths = convert_from_path(
+                pdf_path,
+                dpi=RENDER_DPI,
+                first_page=first_page,
+                last_page=last_page,
+                fmt="jpeg",
+                jpegopt={"quality": RENDER_JPEG_QUALITY, "optimize": True},
+                grayscale=RENDER_GRAYSCALE,
+                size=RENDER_MAX_EDGE,
+                thread_count=RENDER_THREADS,
+                output_folder=out_dir,
+                output_file=f"p{first_page}_",
+                paths_only=True,
+                timeout=PDF_TASK_TIMEOUT,
+            )
+        except PDFPopplerTimeoutError:
+            metrics.inc("pdf_task_timeouts_total", kind="render")
+            raise
+    files = {}
+    for path in paths:
+        m = _PAGE_FILE.search(path)
+        if m:
+            files[int(m.group(1))] = os.path.basename(path)
+    return files
+
+
+def render_page_numbers(pdf_path, numbers):
+    """
+    キャッシュ上の PDF（pdf_cache.fetch_pdf_file のパス）の指定したページ（1 始まり）の JPEG を
+    Gemini にそのまま渡せる形（{"mime_type": "image/jpeg", "data": bytes} の一覧、ページ順）で返す。
+    PDF にないページは無視する。
+    """
+    out_dir = _render_dir(digest_of(pdf_path))
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    numbers = sorted(set(numbers))
+
+    with _locks.hold(out_dir):
+        manifest = _load_manifest(manifest_path)
+        if manifest is None:
+            # 旧形式（先頭から連続で描画）のキャッシュは描画し直す
+            shutil.rmtree(out_dir, ignore_errors=True)
+            manifest = {"files": {}, "page_count": None}
+        os.makedirs(out_dir, exist_ok=True)
+
+        files = manifest["files"]
+        page_count = manifest["page_count"]
+        missing = [
+            n for n in numbers
+            if str(n) not in files and (page_count is None or n <= page_count)
+        ]
+
+        if missing:
+            for first, last in _runs(missing):
+                if page_count is not None and first > page_count:
+                    break
+                rendered = _render(pdf_path, out_dir, first, last)
+                files.update({str(n): name for n, name in rendered.items()})
+                if len(rendered) < last - first + 1:
+                    # 範囲の途中で PDF が終わった
+                    page_count = max(rendered, default=first - 1)
+            manifest = {"files": files, "page_count": page_count}
+            with open(manifest_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            logging.info(f"🖨️ 画像化: {missing} ページ目 → {out_dir}")
+
+        images = []
+        for n in numbers:
+            name = files.get(str(n))
+            if name is None:
+                continue
+            with open(os.path.join(out_dir, name), "rb") as f:
+                images.append({"mime_type": "image/jpeg", "data": f.read()})
+        return images
+
+
+def render_pages(pdf_path, max_pages):
+    """先頭 max_pages ページの JPEG を render_page_numbers と同じ形で返す"""
+    return render_page_numbers(pdf_path, range(1, max_pages + 1))
@@ -0,0 +1,169 @@
+import logging
+import json
+import os
+import threading
+
+import metrics
+import pdf_workers
+from executor import KeyedLocks, memory_slot
+from pdf_cache import RangeFile, fetch_pdf_file, open_pdf_stream, release_pdf, revalidate, text_path
+
+
+# -------------------------------
+# PDF テキスト抽出（テキスト系ステージ共通）
+# -------------------------------
+# 1 つの PDF につき先頭 TEXT_PAGES ページのテキストを 1 回だけ抽出し、
+# 抽出結果（ページごとのテキスト・総ページ数・テキスト層の有無）を
+# ダウンロードキャッシュの横に保存して 組織名T（3 ページ）と
+# バリューのページ選択（先頭 VALUE_SCAN_PAGES ページ）で使い回す。
+TEXT_PAGES = int(os.getenv("TEXT_PAGES", "30"))
+
+_locks = KeyedLocks()
+
+
+def _page_texts(stream, max_pages, strict):
+    from pypdf import PdfReader
+
+    reader = PdfReader(stream, strict=strict)
+    page_count = len(reader.pages)
+    texts = [
+        reader.pages[i].extract_text() or ""
+        for i in range(min(max_pages, page_count))
+    ]
+    return texts, page_count
+
+
+def _file_page_texts(path, max_pages):
+    """ワーカープロセスで実行する（pdf_workers から呼ばれるのでモジュール直下に置く）"""
+    with open(path, "rb") as f:
+        return _page_texts(f, max_pages, False)
+
+
+def read_page_texts(stream, max_pages, strict=False):
+    """(先頭 max_pages ページのテキスト一覧, 総ページ数) を返す。部分取得（RangeFile）用にこのスレッドで解析する"""
+    with memory_slot(), metrics.timer("pdf_parse_seconds"):
+        return _page_texts(stream, max_pages, strict)
+
+
+def read_file_texts(path, max_pages):
+    """キャッシュ上の PDF ファイルを read_page_texts と同じ形で、ワーカープロセスで解析する"""
+    with memory_slot(), metrics.timer("pdf_parse_seconds"):
+        return pdf_workers.run(_file_page_texts, path, max_pages, kind="parse")
+
+
+def _extract(url, max_pages, timeout):
+    """
+    Range 対応サーバーなら必要な部分だけ取得し、解析できなければ全体取得でやり直す。
+    (ステータスコード, (テキスト一覧, 総ページ数)) を返す。
+    """
+    status, stream = open_pdf_stream(url, timeout=timeout)
+    if status != 200:
+        return status, None
+
+    if not isinstance(stream, RangeFile):
+        # キャッシュ上のファイル → パスだけ渡してワーカープロセスで解析する（閉じるまで削除されない）
+        with stream:
+            return 200, read_file_texts(stream.name, max_pages)
+
+    with stream:
+        # strict=False だと pypdf が全オブジェクトを走査して結局全体を読むため strict で開く
+        try:
+            return 200, read_page_texts(stream, max_pages, strict=True)
+        except Exception as e:
+            logging.info(f"↩️ 部分取得で解析できず全体取得に切替 {e}: {url}")
+
+    status, path = fetch_pdf_file(url, timeout=timeout)
+    if status != 200:
+        return status, None
+    try:
+        return 200, read_file_texts(path, max_pages)
+    finally:
+        release_pdf(path)
+
+
+def _load(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            artifact = json.load(f)
+        os.utime(path)  # LRU 用に最終利用時刻を更新
+        return artifact
+    except (OSError, ValueError):
+        return None
+
+
+def _save(path, artifact):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(artifact, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def get_text_artifact(url, max_pages, timeout=20):
+    """
+    URL の PDF のテキスト抽出結果を (ステータスコード, 抽出結果) で返す。
+    抽出結果 = {"page_count": 総ページ数, "pages": 先頭ページのテキスト一覧, "has_text_layer": bool}
+    """
+    path = text_path(url)
+
+    with _locks.hold(url):
+        # PDF が差し替わっていれば抽出結果は捨てられ、下で抽出し直す
+        revalidate(url, timeout)
+        artifact = _load(path)
+        if artifact is not None and (
+            len(artifact["pages"]) >= max_pages
+            or len(artifact["pages"]) >= artifact["page_count"]
+        ):
+            return 200, artifact
+
+        status, result = _extract(url, max(max_pages, TEXT_PAGES), timeout)
+        if status != 200:
+            return status, None
+
+        texts, page_count = result
+        artifact = {
+            "page_count": page_count,
+            "pages": texts,
+            "has_text_layer": any(t.strip() for t in texts),
+        }
+        try:
+            _save(path, artifact)
+        except OSError as e:
+            logging.warning(f"⚠️ テキスト抽出結果の保存失敗 {e}: {url}")
+        return 200, artifact
+
+
+def fetch_page_texts(url, max_pages, timeout=20):
+    """URL の PDF の先頭 max_pages ページのテキストを (ステータスコード, テキスト一覧) で返す"""
+    status, artifact = get_text_artifact(url, max_pages, timeout=timeout)
+    if status != 200:
+        return status, None
+    return 200, artifact["pages"][:max_pages]
+
+
+def download_and_extract(url, extract, label, pages=None, timeout=20):
+    """
+    PDF を取得して extract に渡し、その結果を返す（取得・抽出に失敗したら '取得失敗'）。
+    pages を指定した場合は PDF のパスではなく先頭 pages ページのテキストを extract に渡す。
+    """
+    try:
+        if pages:
+            status, pdf = fetch_page_texts(url, pages, timeout=timeout)
+        else:
+            status, pdf = fetch_pdf_file(url, timeout=timeout)
+
+        if status == 200:
+            try:
+                extracted = extract(pdf)
+            finally:
+                if not pages:
+                    release_pdf(pdf)  # 解析・画像化が終わるまでキャッシュから消さない
+            logging.info(f"{label}: {url} → {extracted}")
+            return extracted
+
+        logging.warning(f"⚠️ DL失敗 {status}: {url}")
+        return "取得失敗"
+
+    except Exception as e:
+        logging.warning(f"❌ 例外発生 {e}: {url}")
+        return "取得失敗"
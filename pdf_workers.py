@@ -0,0 +1,128 @@
+import logging
+import multiprocessing
+import os
+import threading
+
+import metrics
+
+
+# -------------------------------
+# PDF 解析用のワーカープロセス
+# -------------------------------
+# pypdf のテキスト抽出は GIL を握ったままなので、スレッドを増やしても 1 コアしか使えない。
+# 常駐するワーカープロセスに「ファイルパスと引数」だけを渡して実行し、複数コアで並列に解析する
+# （PDF 本体は pickle で送らず、各プロセスがキャッシュ上のファイルを直接読む）。
+# PDF_WORKERS      : ワーカープロセス数（0 ならプロセスを使わず呼び出し元のスレッドで実行）
+# PDF_TASK_TIMEOUT : 1 件あたりの上限秒数。超えたらそのワーカーを強制終了して作り直す
+#                    （壊れた・異常に重い PDF で実行全体が止まらないようにする）
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(_cpu_count())))
+PDF_TASK_TIMEOUT = float(os.getenv("PDF_TASK_TIMEOUT", "60"))
+
+
+class TaskTimeout(TimeoutError):
+    pass
+
+
+class WorkerDied(RuntimeError):
+    pass
+
+
+def _worker_main(conn):
+    """ワーカープロセス本体: (関数, 引数) を受け取って実行し、(成否, 結果または例外) を返す"""
+    while True:
+        try:
+            func, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            reply = (True, func(*args))
+        except Exception as e:
+            reply = (False, e)
+        try:
+            conn.send(reply)
+        except Exception:
+            # pickle できない例外は文字列にして返す
+            conn.send((False, RuntimeError(f"{type(reply[1]).__name__}: {reply[1]}")))
+
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    def __init__(self, size):
+        # fork だと他のスレッドが持っていたロックごと複製されるため、forkserver から起動する
+        self._ctx = multiprocessing.get_context("forkserver")
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _take(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return _Worker(self._ctx)
+
+    def run(self, func, args, timeout, kind):
+        with self._slots:
+            worker = self._take()
+            healthy = False
+            try:
+                try:
+                    worker.conn.send((func, args))
+                    finished = worker.conn.poll(timeout)
+                    if finished:
+                        ok, result = worker.conn.recv()
+                except (EOFError, OSError) as e:
+                    raise WorkerDied(f"ワーカープロセスが異常終了: {e}") from e
+                if not finished:
+                    metrics.inc("pdf_task_timeouts_total", kind=kind)
+                    raise TaskTimeout(f"{kind} が {timeout:.0f} 秒で終わらずワーカーを停止")
+                healthy = True
+            finally:
+                if healthy:
+                    with self._lock:
+                        self._idle.append(worker)
+                else:
+                    worker.kill()
+                    logging.warning(f"🔪 PDF ワーカーを停止（{kind}）。次の処理で新しく起動する")
+
+        if ok:
+            return result
+        raise result
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def run(func, *args, kind="parse"):
+    """
+    func(*args) をワーカープロセスで実行して結果を返す（例外もそのまま送出する）。
+    func はモジュール直下の関数、args は pickle できる小さな値（ファイルパスなど）にすること。
+    """
+    global _pool
+    if PDF_WORKERS <= 0:
+        return func(*args)
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(PDF_WORKERS)
+            logging.info(f"⚙️ PDF ワーカープロセス: {PDF_WORKERS}")
+    return _pool.run(func, args, PDF_TASK_TIMEOUT, kind)
@@ -1,34 +1,94 @@
 import logging
-import pandas as pd
-import gspread
-from gspread_dataframe import get_as_dataframe
-from google.oauth2 import service_account
+import os
+import threading
 import time
-import numpy as np
-
-def read_sheet():
-    SPREADSHEET_ID = '18Sb4CcAE5JPFeufHG97tLZz9Uj_TvSGklVQQhoFF28w'
-    WORKSHEET_NAME = 'バリュー抽出'
-
-    try:
-        creds = service_account.Credentials.from_service_account_file(
-            '/secrets/service-account-json',
-            scopes=[
-                'https://www.googleapis.com/auth/spreadsheets',
-                'https://www.googleapis.com/auth/drive'
-            ]
-        )
-        gc = gspread.authorize(creds)
-        sh = gc.open_by_key(SPREADSHEET_ID)
-        worksheet = sh.worksheet(WORKSHEET_NAME)
-
-        existing_df = get_as_dataframe(worksheet).dropna(subset=['URL'])
-        processed_urls = set(existing_df['URL'].tolist())
-
-        logging.info(f'✅ 取得済URL数: {len(processed_urls)}')
-        return worksheet, existing_df, processed_urls
-
-    except Exception as e:
-        import traceback
-        logging.error('❌ エラー発生:\n' + traceback.format_exc())
-        return f'エラー: {e}', 500
+
+import metrics
+
+
+# -------------------------------
+# スプレッドシートの接続（プロセス内で使い回す）
+# -------------------------------
+# SPREADSHEET_ID       : 対象のスプレッドシート ID
+# WORKSHEET_NAME       : 対象のタブ名
+# SERVICE_ACCOUNT_FILE : サービスアカウントの JSON キー
+# SHEET_HANDLE_TTL     : 開いたワークシートを使い回す秒数（過ぎたら開き直してタブの変更を拾う）
+# 認証済みクライアントとワークシートは最初のリクエストで 1 回だけ作り、以降のリクエストでは
+# 認証・open_by_key・worksheet の往復を省く。アクセストークンは期限が近づくと
+# gspread の AuthorizedSession が自動で更新する。
+# 接続・認証のエラーが出たら reset_worksheet() で捨て、次の open_worksheet() で開き直す。
+SPREADSHEET_ID = os.getenv("SPREADSHEET_ID", "18Sb4CcAE5JPFeufHG97tLZz9Uj_TvSGklVQQhoFF28w")
+WORKSHEET_NAME = os.getenv("WORKSHEET_NAME", "バリュー抽出")
+SERVICE_ACCOUNT_FILE = os.getenv("SERVICE_ACCOUNT_FILE", "/secrets/service-account-json")
+SHEET_HANDLE_TTL = float(os.getenv("SHEET_HANDLE_TTL", "3600"))
+
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+_lock = threading.Lock()
+_client = None
+_worksheet = None
+_opened_at = 0.0
+
+
+def _authorize():
+    import gspread
+    from google.oauth2 import service_account
+
+    creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+    return gspread.authorize(creds)
+
+
+def open_worksheet(refresh=False):
+    """
+    キャッシュ済みのワークシートを返す。まだ開いていない・SHEET_HANDLE_TTL を過ぎた・
+    refresh=True のときは開き直す（refresh=True なら認証もやり直す）。
+    """
+    global _client, _worksheet, _opened_at
+
+    with _lock:
+        if refresh:
+            _client = None
+        if _worksheet is not None and not refresh and time.monotonic() - _opened_at < SHEET_HANDLE_TTL:
+            return _worksheet
+
+        if _client is None:
+            _client = _authorize()
+        sh = _client.open_by_key(SPREADSHEET_ID)
+        _worksheet = sh.worksheet(WORKSHEET_NAME)
+        _opened_at = time.monotonic()
+        # open_by_key と worksheet でそれぞれメタデータを 1 回ずつ取得する
+        metrics.inc("sheet_api_calls_total", 2, op="open")
+        logging.info(f"🔗 シート接続: {SPREADSHEET_ID}/{WORKSHEET_NAME}")
+        return _worksheet
+
+
+def reset_worksheet():
+    """キャッシュしたクライアントとワークシートを捨てる（次回の open_worksheet で開き直す）"""
+    global _client, _worksheet
+
+    with _lock:
+        _client = None
+        _worksheet = None
+
+
+def is_connection_error(e):
+    """開き直せば直る可能性のあるエラー（接続断・認証切れ・シートやタブの差し替え）か"""
+    import gspread
+    import requests
+    from google.auth import exceptions as auth_exceptions
+
+    if isinstance(e, (
+        requests.ConnectionError,
+        auth_exceptions.TransportError,
+        auth_exceptions.RefreshError,
+        gspread.exceptions.WorksheetNotFound,
+    )):
+        return True
+    if isinstance(e, gspread.exceptions.APIError):
+        status = getattr(e.response, "status_code", None)
+        # タブ名が変わると範囲指定の解析エラー（400）になる
+        return status in (401, 404) or "Unable to parse range" in str(e)
+    return False
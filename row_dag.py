@@ -0,0 +1,210 @@
+import heapq
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+from cascade import CASCADE_MODE
+from dedup import RowGroups, pdf_key, company_key, WAIT, DONE
+from executor import ROW_CONCURRENCY
+from llm_batch import LLM_BATCH_SIZE, LLM_BATCH_WAIT
+from run_budget import current_run
+import update_組織名 as org
+import update_価値ある活動 as value
+
+
+# -------------------------------
+# 行単位の依存グラフ（DAG）で全ステージを実行する
+# -------------------------------
+# ステージごとに全行を処理し終えるのを待たず、各行の処理は入力列が揃った時点で着手する。
+#   会社名T, 会社名G → 会社名 → 証券番号
+#                      会社名 → バリューT, バリューG → バリュー
+# カスケードモードでは G が同じ行の T の結果を見るため、T → G の依存を足す。
+# 行ごとの判定（plan_xxx）と処理（work_xxx）はステージ一括処理と共通。
+# batched のステージは行を溜め、LLM_BATCH_SIZE 件か LLM_BATCH_WAIT 秒で 1 回の問い合わせにまとめる。
+# 着手順は「下流の処理を優先、同じ深さなら上の行から」なので、行が順に完成していく。
+# 全列が埋まった行ごとに RunBudget.tick() を呼び、チェックポイント書き込みの対象にする。
+# ステージの所要時間は、そのステージの最初の行に着手してから最後の行が終わるまで。
+# key を持つノードは、同じキーの行（同じ PDF・同じ会社）を 1 回だけ処理して結果を配る（dedup.py）。
+class Node:
+    def __init__(self, stage, column, deps, plan, work, batched=False, key=None):
+        self.stage = stage
+        self.batched = batched
+        self.key = key
+        self.column = column
+        self.deps = deps
+        self.plan = plan
+        self.work = work
+        self.children = []
+        self.depth = 0
+        self.index = 0
+
+
+NODES = [
+    Node("update_組織名T", "会社名T", [], org.plan_組織名T, org.work_組織名T, key=pdf_key),
+    Node("update_組織名G", "会社名G", ["会社名T"] if CASCADE_MODE else [], org.plan_組織名G, org.work_組織名G,
+         key=pdf_key),
+    Node("update_組織名", "会社名", ["会社名T", "会社名G"], org.plan_組織名, org.work_組織名, batched=True),
+    Node("update_証券番号", "証券番号", ["会社名"], org.plan_証券番号, org.work_証券番号, batched=True,
+         key=company_key),
+    Node("update_バリューT", "バリューT", ["会社名"], value.plan_バリューT, value.work_バリューT, key=pdf_key),
+    Node("update_バリューG", "バリューG", ["会社名"] + (["バリューT"] if CASCADE_MODE else []),
+         value.plan_バリューG, value.work_バリューG, key=pdf_key),
+    Node("update_バリュー", "バリュー", ["バリューT", "バリューG"], value.plan_バリュー, value.work_バリュー),
+]
+
+_by_column = {node.column: node for node in NODES}
+for _index, _node in enumerate(NODES):  # NODES は依存元が先に並んでいる
+    _node.index = _index
+    for _dep in _node.deps:
+        _by_column[_dep].children.append(_node)
+    _node.depth = max([_by_column[d].depth + 1 for d in _node.deps], default=0)
+
+
+def run_dag(df, job=None):
+    """df の全行を DAG に沿って処理し、結果を df に書き込む（メインスレッドで書く）"""
+    run = current_run()
+
+    for node in NODES:
+        if node.column not in df.columns:
+            df[node.column] = ''
+
+    done = {idx: set() for idx in df.index}
+    order_of = {idx: order for order, idx in enumerate(df.index)}
+    counts = {node.stage: 0 for node in NODES}
+    remaining = {node.index: len(df) for node in NODES}
+    started = {}  # ノード番号 → 最初の行に着手した時刻
+    ended = set()
+    groups = [RowGroups(node.stage, node.key) for node in NODES]
+
+    # (-深さ, 行順, ノード番号, idx) の小さい順に着手する
+    ready = []
+
+    def push(idx, node):
+        heapq.heappush(ready, (-node.depth, order_of[idx], node.index, idx))
+
+    for idx in df.index:
+        for node in NODES:
+            if not node.deps:
+                push(idx, node)
+
+    workers = max(1, ROW_CONCURRENCY)
+    logging.info(f"⚙️ 行単位スケジューラ: {len(df)} 行 / {workers} スレッド")
+
+    def start_stage(node):
+        if node.index not in started:
+            started[node.index] = time.monotonic()
+            if job is not None:
+                job.stage_started(node.stage)
+
+    def end_stage(node, error=None):
+        ended.add(node.index)
+        metrics.observe("pipeline_stage_seconds", time.monotonic() - started[node.index], stage=node.stage)
+        if job is not None:
+            job.stage_finished(node.stage, counts[node.stage], error=error)
+
+    def finish(idx, node, result):
+        if result is not None:
+            df.at[idx, node.column] = result
+            counts[node.stage] += 1
+            metrics.inc("pipeline_stage_rows_total", stage=node.stage)
+            if job is not None:
+                job.stage_progress(node.stage, counts[node.stage])
+
+        done[idx].add(node.column)
+        remaining[node.index] -= 1
+        if remaining[node.index] == 0:
+            end_stage(node)
+
+        for child in node.children:
+            if all(d in done[idx] for d in child.deps):
+                push(idx, child)
+
+        if len(done[idx]) == len(NODES) and run is not None:
+            run.tick()
+
+    # まとめて問い合わせるステージ（会社名・証券番号）の、まだ送っていない行
+    buffers = {node.index: [] for node in NODES if node.batched}
+    buffered_since = {}
+
+    current = {"node": None}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+
+        def flush(node):
+            chunk, buffers[node.index] = buffers[node.index], []
+            running[pool.submit(node.work, chunk)] = (None, node, time.monotonic())
+
+        def submit():
+            # 予算切れでなければ、同時実行数の 2 倍まで先行して投入する
+            while ready and len(running) < workers * 2:
+                if run is not None and run.expired():
+                    logging.warning(f"⏰ 実行時間の予算切れ: 未着手 {len(ready)} 件は次回に持ち越し")
+                    ready.clear()
+                    return
+                _, _, n, idx = heapq.heappop(ready)
+                node = current["node"] = NODES[n]
+                start_stage(node)
+                result, args = node.plan(df.loc[idx])
+                if args is None:
+                    finish(idx, node, result)
+                    continue
+
+                # 同じ処理が実行中ならその結果を待ち、済んでいればその結果を使う
+                state, shared = groups[n].join(idx, args[0] if node.batched else args)
+                if state == DONE:
+                    finish(idx, node, shared)
+                elif state == WAIT:
+                    continue
+                elif node.batched:
+                    if not buffers[node.index]:
+                        buffered_since[node.index] = time.monotonic()
+                    buffers[node.index].append((idx, args[0]))
+                    if len(buffers[node.index]) >= LLM_BATCH_SIZE:
+                        flush(node)
+                else:
+                    running[pool.submit(node.work, *args)] = (idx, node, time.monotonic())
+
+        def flush_due(force):
+            # 件数が揃わなくても、待ち時間を過ぎたか他に進める処理がなければ送る
+            now = time.monotonic()
+            for node in NODES:
+                if node.batched and buffers[node.index] and (
+                    force or now - buffered_since[node.index] >= LLM_BATCH_WAIT
+                ):
+                    flush(node)
+
+        def next_due():
+            pending = [buffered_since[i] for i, buf in buffers.items() if buf]
+            if not pending:
+                return None
+            return max(0, min(pending) + LLM_BATCH_WAIT - time.monotonic())
+
+        error = None
+        try:
+            submit()
+            while running or any(buffers.values()):
+                if not running:
+                    flush_due(force=True)
+                finished, _ = wait(running, timeout=next_due(), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    idx, node, submitted = running.pop(future)
+                    current["node"] = node
+                    metrics.observe("pipeline_task_seconds", time.monotonic() - submitted, stage=node.stage)
+                    results = future.result() if node.batched else [(idx, future.result())]
+                    for row_idx, result in results:
+                        for member in groups[node.index].resolve(row_idx, result):
+                            finish(member, node, result)
+                flush_due(force=False)
+                submit()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # 途中で終わったステージ（予算切れ・例外）を閉じる。例外は起きたステージにだけ記録する
+            for node in NODES:
+                if node.index in started and node.index not in ended:
+                    failed = error is not None and node is current["node"]
+                    end_stage(node, error=error if failed else None)
+
+    logging.info("📄 行単位スケジューラ完了: " + ", ".join(f"{k} {v} 件" for k, v in counts.items()))
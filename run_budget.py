@@ -0,0 +1,79 @@
+import os
+import time
+
+from sheet_io import write_changes
+
+
+# -------------------------------
+# 実行時間の予算とチェックポイント書き込み
+# -------------------------------
+# RUN_TIME_BUDGET      : 1 回の実行に使う秒数。Cloud Run のタイムアウトより少し短くする（0 なら無制限）
+# CHECKPOINT_ROWS      : この行数を処理するごとに途中結果をシートへ書き込む
+# CHECKPOINT_SECONDS   : 前回の書き込みからこの秒数が経ったら途中結果を書き込む
+# 予算を使い切ると新しい行は始めず、処理中の行だけ終えて書き込む。
+# 未処理の行は空欄のまま残るので、次回の実行でそこから再開される。
+RUN_TIME_BUDGET = float(os.getenv("RUN_TIME_BUDGET", "0"))
+CHECKPOINT_ROWS = int(os.getenv("CHECKPOINT_ROWS", "50"))
+CHECKPOINT_SECONDS = float(os.getenv("CHECKPOINT_SECONDS", "120"))
+
+_current = None
+
+
+class RunBudget:
+    def __init__(self, worksheet, df):
+        self.worksheet = worksheet
+        self.df = df
+        self.committed = df.copy()
+        self.started = time.monotonic()
+        self.deadline = self.started + RUN_TIME_BUDGET if RUN_TIME_BUDGET > 0 else None
+        self.rows = 0
+        self.processed = 0
+        self.last_flush = self.started
+        self.on_tick = None
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def tick(self):
+        """1 行分の結果が DataFrame に反映されたら呼ぶ"""
+        self.rows += 1
+        self.processed += 1
+        if self.on_tick is not None:
+            self.on_tick()
+        if (
+            self.rows >= CHECKPOINT_ROWS
+            or time.monotonic() - self.last_flush >= CHECKPOINT_SECONDS
+        ):
+            self.flush()
+
+    def flush(self):
+        """前回書き込み時点から変わったセルだけを書き込む"""
+        write_changes(self.worksheet, self.committed, self.df)
+        self.committed = self.df.copy()
+        self.rows = 0
+        self.last_flush = time.monotonic()
+
+
+def start_run(worksheet, df):
+    global _current
+    _current = RunBudget(worksheet, df)
+    return _current
+
+
+def end_run():
+    """最後の書き込みを行う。書き込みに失敗しても実行中の RunBudget は外す"""
+    global _current
+    run, _current = _current, None
+    if run is not None:
+        run.flush()
+
+
+def row_done():
+    """ステージが df のセルを 1 つ書き込むごとに呼ぶ（パイプライン実行中でなければ何もしない）"""
+    if _current is not None:
+        _current.tick()
+
+
+def current_run():
+    """パイプライン実行中なら RunBudget、単独実行なら None"""
+    return _current
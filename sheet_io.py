@@ -0,0 +1,208 @@
+import logging
+import math
+import threading
+
+import metrics
+
+
+# -------------------------------
+# Excel 列名変換（0 始まり → A, B, ..., Z, AA, ...）
+# -------------------------------
+def col_to_letter(index):
+    letters = ""
+    while index >= 0:
+        index, rem = divmod(index, 26)
+        letters = chr(65 + rem) + letters
+        index -= 1
+    return letters
+
+
+# -------------------------------
+# シートを DataFrame として 1 回だけ読む
+# -------------------------------
+# 返す DataFrame の index はシートの行番号（ヘッダーが 1 行目なのでデータは 2 行目から）。
+# 列ごとのシート上の位置を df.attrs["sheet_columns"]（列名 → 0 始まりの列番号）に持ち、
+# 書き戻し（dirty_ranges）はそれを使うので、一部の列だけ読んだ DataFrame でも正しい列に書ける。
+# 値は文字列、NUMERIC_COLUMNS だけ数値（空欄・数値でない値は ''）。
+NUMERIC_COLUMNS = ["ページ数"]
+
+# ワークシートごとのヘッダー行。列を絞った読み込みでは毎回ヘッダーも一緒に読んで照合し、
+# 変わっていたら読み直す（通常は batch_get 1 回で済む）
+_headers = {}
+_headers_lock = threading.Lock()
+
+
+def _worksheet_key(worksheet):
+    return getattr(worksheet.spreadsheet, "id", None), getattr(worksheet, "id", None)
+
+
+def _read_header(worksheet):
+    header = worksheet.row_values(1)
+    metrics.inc("sheet_api_calls_total", op="read")
+    with _headers_lock:
+        _headers[_worksheet_key(worksheet)] = header
+    return header
+
+
+def _read_columns(worksheet, columns):
+    """(ヘッダー, {列名: 2 行目以降の値の一覧}) を返す。シートにない列は含まない"""
+    with _headers_lock:
+        header = _headers.get(_worksheet_key(worksheet))
+    # 列がキャッシュにない場合も、その後に追加された列かもしれないので読み直す
+    cached = header is not None and all(c in header for c in columns)
+    if not cached:
+        header = _read_header(worksheet)
+
+    while True:
+        present = [c for c in columns if c in header]
+        ranges = []
+        for name in present:
+            letter = col_to_letter(header.index(name))
+            ranges.append(f"{letter}1:{letter}")
+
+        values = worksheet.batch_get(ranges, major_dimension="COLUMNS") if ranges else []
+        metrics.inc("sheet_api_calls_total", op="read")
+        cells = [list(v[0]) if v else [] for v in values]
+
+        if all(col[:1] == [name] for col, name in zip(cells, present)):
+            return header, {name: col[1:] for name, col in zip(present, cells)}
+        if not cached:
+            raise RuntimeError(f"シートのヘッダーが読み込み中に変わりました: {present}")
+
+        # キャッシュしていたヘッダーが古い（列の追加・並べ替え）→ 読み直してやり直す
+        logging.info("🔁 シートのヘッダー変更を検出、列位置を読み直し")
+        header = _read_header(worksheet)
+        cached = False
+
+
+def _typed(df):
+    import pandas as pd
+
+    for col in NUMERIC_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col].replace('', None), errors="coerce")
+    return df.fillna('')
+
+
+def load_sheet_df(worksheet, columns):
+    """
+    columns の列だけを batch_get で読む（列の位置はヘッダー行から調べる）。
+    シートにない列は含めず、全列が空の行は除く。
+    """
+    import pandas as pd  # 起動時間を短くするため、初回の読み込み時まで遅らせる
+
+    header, values = _read_columns(worksheet, columns)
+    rows = max((len(v) for v in values.values()), default=0)
+    df = pd.DataFrame(
+        {name: [str(v) for v in values[name]] + [''] * (rows - len(values[name])) for name in values},
+        index=range(2, rows + 2),
+        dtype=object,
+    )
+    df = df[(df != '').any(axis=1)] if len(df.columns) else df
+    df.attrs["sheet_columns"] = {name: header.index(name) for name in values}
+    df.attrs["sheet_width"] = len(header)
+    logging.info(f"📥 シート読み込み: {len(df)} 行 / {len(values)} 列（{', '.join(values)}）")
+    return _typed(df)
+
+
+def _cell(v):
+    if isinstance(v, float) and (math.isnan(v) or math.isinf(v)):
+        return ''
+    return v
+
+
+# -------------------------------
+# 変更セルだけを書き戻す
+# -------------------------------
+def dirty_ranges(before, after, columns=None):
+    """
+    before → after で値が変わったセルを列ごとの連続範囲にまとめ、
+    batch_update に渡せる [{"range": "C5:C7", "values": [[..], ..]}, ...] を返す。
+    before に無い列（新規列）は空欄からの変更として扱う。
+    行は after の index（シートの行番号）、列は after.attrs["sheet_columns"] の位置に書く。
+    シートにまだない列は、シートの右端の後ろに DataFrame の列順で並べる。
+    """
+    positions = _column_positions(after)
+    rows = after.index.tolist()
+
+    data = []
+    for col in columns if columns is not None else after.columns:
+        new = [_cell(v) for v in after[col].tolist()]
+        if col in before.columns:
+            old = [_cell(v) for v in before[col].reindex(after.index, fill_value='').tolist()]
+        else:
+            old = [''] * len(new)
+
+        dirty = [i for i, (a, b) in enumerate(zip(old, new)) if a != b]
+        if not dirty:
+            continue
+
+        col_letter = col_to_letter(positions[col])
+        start = prev = dirty[0]
+        for i in dirty[1:] + [None]:
+            # シート上で隣り合う行だけを 1 つの範囲にまとめる（空行を除いた DataFrame では飛びがある）
+            if i is not None and rows[i] == rows[prev] + 1:
+                prev = i
+                continue
+            data.append({
+                "range": f"{col_letter}{rows[start]}:{col_letter}{rows[prev]}",
+                "values": [[v] for v in new[start:prev + 1]],
+            })
+            start = prev = i
+    return data
+
+
+def _column_positions(df):
+    """列名 → シート上の列番号（0 始まり）"""
+    positions = dict(df.attrs.get("sheet_columns") or {})
+    if not positions:
+        return {name: i for i, name in enumerate(df.columns)}
+
+    next_position = df.attrs.get("sheet_width", len(positions))
+    for name in df.columns:
+        if name not in positions:
+            positions[name] = next_position
+            next_position += 1
+    return positions
+
+
+def _new_headers(worksheet, df):
+    """
+    シートにまだない列のヘッダーセル（1 行目）を返し、その列をシート上の列として登録する。
+    登録しないと、次に書き込む列や次回の読み込みが同じ列位置を使ってしまう。
+    """
+    positions = _column_positions(df)
+    known = df.attrs.setdefault("sheet_columns", {})
+    added = {name: positions[name] for name in df.columns if name not in known}
+    if not added:
+        return []
+
+    known.update(added)
+    df.attrs["sheet_width"] = max([df.attrs.get("sheet_width", 0)] + [i + 1 for i in added.values()])
+
+    key = _worksheet_key(worksheet)
+    with _headers_lock:
+        header = _headers.get(key)
+        if header is not None:
+            header = list(header) + [''] * max(0, df.attrs["sheet_width"] - len(header))
+            for name, i in added.items():
+                header[i] = name
+            _headers[key] = header
+
+    return [
+        {"range": f"{col_to_letter(i)}1:{col_to_letter(i)}1", "values": [[name]]}
+        for name, i in added.items()
+    ]
+
+
+def write_changes(worksheet, before, after, columns=None):
+    """変わったセルだけを 1 回の batch_update で書き込む"""
+    data = dirty_ranges(before, after, columns)
+    if not data:
+        return
+
+    data += _new_headers(worksheet, after)
+    worksheet.batch_update(data)
+    metrics.inc("sheet_api_calls_total", op="write")
+    cells = sum(len(d["values"]) for d in data)
+    logging.info(f"📤 シート書き込み: {cells} セル / {len(data)} 範囲")
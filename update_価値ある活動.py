@@ -1,51 +1,46 @@
 import logging
-import requests
-import numpy as np
-from io import BytesIO
-from pypdf import PdfReader
-from pdf2image import convert_from_bytes
 import warnings
-from gspread_dataframe import get_as_dataframe
-import google.generativeai as genai
-import os
+
+from pdf_cache import cached_first
+from pdf_text import download_and_extract, get_text_artifact
+from pdf_render import render_page_numbers
+from page_select import VALUE_SCAN_PAGES, value_pages
+from sheet_io import load_sheet_df, write_changes
+from executor import run_rows
+from run_budget import row_done
+from llm_cache import generate_text
+from gemini_client import get_model
+from cascade import SKIPPED, skip_image_stage, value_confident
+from dedup import group_tasks, pdf_key
 
 
 # -------------------------------
-# Gemini 初期化（共通）
+# 各ステージがシートから読む列（単独実行時はこの列だけを読む）
 # -------------------------------
-def init_gemini():
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("環境変数 GEMINI_API_KEY が設定されていません")
-    genai.configure(api_key=api_key)
-    return genai.GenerativeModel("gemini-2.5-flash")
-
-text_model = None
-image_model = None
+COLUMNS_バリューT = ["URL", "会社名", "バリューT"]
+COLUMNS_バリューG = ["URL", "会社名", "バリューT", "バリューG"]
+COLUMNS_バリュー = ["URL", "会社名", "バリューT", "バリューG", "バリュー"]
+SHEET_COLUMNS = list(dict.fromkeys(COLUMNS_バリューT + COLUMNS_バリューG + COLUMNS_バリュー))
 
 
 # ============================================================
 #  1) バリュー（テキスト版）抽出
 # ============================================================
-def extract_value_from_text(pdf_bytes):
-    global text_model
-    if text_model is None:
-        text_model = init_gemini()
+def extract_value_from_text(page_texts):
+    model = get_model()
 
     try:
-        reader = PdfReader(BytesIO(pdf_bytes))
-        all_text = ""
-
-        for i in range(min(10, len(reader.pages))):
-            text = reader.pages[i].extract_text()
-            if text:
-                all_text += text + "\n"
+        all_text = "".join(
+            f"--- {i + 1} ページ ---\n{page_texts[i]}\n"
+            for i in value_pages(page_texts)
+            if i < len(page_texts) and page_texts[i]
+        )
 
         if not all_text.strip():
             return "取得失敗"
 
         prompt = """
-        以下は企業の統合報告書です。
+        以下は企業の統合報告書から選んだページのテキストです。
         この中から企業が提示している「バリュー」「行動指針」「価値観」「行動規範」に該当する内容を150文字以内で要約してください。
 
         ・社員がどのような行動や姿勢を求められているかを優先
@@ -54,8 +49,7 @@ def extract_value_from_text(pdf_bytes):
         ・取得できない場合は「取得失敗」とだけ返す
         """
 
-        response = text_model.generate_content([prompt, all_text])
-        result = response.text.strip()
+        result = generate_text(model, [prompt, all_text], "value_text/v2").strip()
 
         return result if result else "取得失敗"
 
@@ -67,69 +61,60 @@ def extract_value_from_text(pdf_bytes):
 # ============================================================
 #  update_バリューT（テキスト）
 # ============================================================
-def update_バリューT(worksheet):
-    logging.info("🧭 update_バリューT 開始")
-
-    df = get_as_dataframe(worksheet)
-    df.fillna('', inplace=True)
-
-    if 'バリューT' not in df.columns:
-        df['バリューT'] = ''
+# -------------------------------
+# 行ごとの判定と処理（update_組織名 の plan_xxx / work_xxx と同じ形）
+# -------------------------------
+def plan_バリューT(row):
+    url = row.get("URL", "")
+    val_t = row.get("バリューT", "")
+    company = row.get("会社名", "")
 
-    update_count = 0
+    if not url or val_t:
+        return None, None
 
-    for idx, row in df.iterrows():
-        url = row.get("URL", "")
-        val_t = row.get("バリューT", "")
-        company = row.get("会社名", "")
+    if company in ["対象外", "取得失敗", ""]:
+        logging.info(f"⏭️ 対象外（会社名）: {url}")
+        return "対象外", None
 
-        if not url or val_t:
-            continue
+    return None, (url,)
 
-        if company in ["対象外", "取得失敗", ""]:
-            df.at[idx, "バリューT"] = "対象外"
-            update_count += 1
-            logging.info(f"⏭️ 対象外（会社名）: {url}")
-            continue
 
-        try:
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            res = requests.get(url, headers=headers, timeout=20)
+def work_バリューT(url):
+    return download_and_extract(url, extract_value_from_text, "📝 抽出(T)", pages=VALUE_SCAN_PAGES)
 
-            if res.status_code == 200:
-                extracted = extract_value_from_text(res.content)
-                df.at[idx, "バリューT"] = extracted
-                update_count += 1
-                logging.info(f"📝 抽出(T): {url} → {extracted}")
 
-            else:
-                df.at[idx, "バリューT"] = "取得失敗"
-                update_count += 1
-                logging.warning(f"⚠️ DL失敗 {res.status_code}: {url}")
+def update_バリューT(worksheet, df=None):
+    logging.info("🧭 update_バリューT 開始")
 
-        except Exception as e:
-            df.at[idx, "バリューT"] = "取得失敗"
-            update_count += 1
-            logging.warning(f"❌ 例外発生 {e}: {url}")
+    standalone = df is None
+    if standalone:
+        df = load_sheet_df(worksheet, COLUMNS_バリューT)
+        before = df.copy()
 
-    df.replace([np.nan, np.inf, -np.inf], '', inplace=True)
+    if 'バリューT' not in df.columns:
+        df['バリューT'] = ''
 
-    # Excel 列名変換
-    def col_to_letter(index):
-        letters = ""
-        while index >= 0:
-            index, rem = divmod(index, 26)
-            letters = chr(65 + rem) + letters
-            index -= 1
-        return letters
+    update_count = 0
+    tasks = []
 
-    col_index = df.columns.get_loc("バリューT")
-    col_letter = col_to_letter(col_index)
+    for idx, row in df.iterrows():
+        value, args = plan_バリューT(row)
+        if value is not None:
+            df.at[idx, "バリューT"] = value
+            update_count += 1
+            row_done()
+        elif args is not None:
+            tasks.append((idx, args))
+
+    tasks, members = group_tasks(tasks, pdf_key, "update_バリューT")
+    for idx, extracted in run_rows(work_バリューT, tasks, key=cached_first):
+        for member in members[idx]:
+            df.at[member, "バリューT"] = extracted
+            update_count += 1
+            row_done()
 
-    worksheet.update(
-        f"{col_letter}2:{col_letter}{len(df)+1}",
-        [[v] for v in df["バリューT"].tolist()]
-    )
+    if standalone:
+        write_changes(worksheet, before, df, ["バリューT"])
 
     logging.info(f"📝 {update_count} 件のバリューTを更新")
     return f"{update_count} 件更新", 200
@@ -138,16 +123,14 @@ def update_バリューT(worksheet):
 # ============================================================
 #  2) バリュー（画像版）抽出
 # ============================================================
-def extract_value_from_pdf(pdf_bytes):
-    global image_model
-    if image_model is None:
-        image_model = init_gemini()
+def extract_value_from_pdf(pdf_path, page_numbers):
+    model = get_model()
 
     try:
-        images = convert_from_bytes(pdf_bytes, dpi=200, first_page=1, last_page=10)
+        images = render_page_numbers(pdf_path, page_numbers)
 
         prompt = """
-        この画像は会社の統合報告書の最初の数ページです。
+        この画像は会社の統合報告書から選んだ数ページです。
         会社が記載しているバリュー(Value)、価値観、行動指針、行動規範などの「中身」を150文字以内にまとめてください。
 
         ・社員に求められる姿勢・行動を優先
@@ -155,8 +138,7 @@ def extract_value_from_pdf(pdf_bytes):
         ・取得できない場合は「取得失敗」とだけ返す
         """
 
-        response = image_model.generate_content([prompt, *images])
-        result = response.text.strip()
+        result = generate_text(model, [prompt, *images], "value_image/v2").strip()
 
         return result if result else "取得失敗"
 
@@ -168,69 +150,74 @@ def extract_value_from_pdf(pdf_bytes):
 # ============================================================
 #  update_バリューG（画像）
 # ============================================================
-def update_バリューG(worksheet):
-    logging.info("🖼️ update_バリューG 開始")
+def plan_バリューG(row):
+    url = row.get("URL", "")
+    val_g = row.get("バリューG", "")
+    company = row.get("会社名", "")
 
-    df = get_as_dataframe(worksheet)
-    df.fillna('', inplace=True)
+    if not url or val_g:
+        return None, None
 
-    if 'バリューG' not in df.columns:
-        df['バリューG'] = ''
+    if company in ["対象外", "取得失敗", ""]:
+        logging.info(f"⏭️ 対象外（会社名）: {url}")
+        return "対象外", None
 
-    update_count = 0
+    return None, (url, row.get("バリューT", ""))
 
-    for idx, row in df.iterrows():
-        url = row.get("URL", "")
-        val_g = row.get("バリューG", "")
-        company = row.get("会社名", "")
 
-        if not url or val_g:
-            continue
+def _value_page_numbers(url):
+    """画像化するページ番号（1 始まり）。テキスト層で選べなければ先頭ページ"""
+    try:
+        status, artifact = get_text_artifact(url, VALUE_SCAN_PAGES)
+    except Exception as e:
+        logging.info(f"↩️ ページ選択できず先頭ページを使用 {e}: {url}")
+        status, artifact = None, None
 
-        if company in ["対象外", "取得失敗", ""]:
-            df.at[idx, "バリューG"] = "対象外"
-            update_count += 1
-            logging.info(f"⏭️ 対象外（会社名）: {url}")
-            continue
+    page_texts = artifact["pages"] if status == 200 and artifact["has_text_layer"] else None
+    return [i + 1 for i in value_pages(page_texts)]
 
-        try:
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            res = requests.get(url, headers=headers, timeout=20)
 
-            if res.status_code == 200:
-                extracted = extract_value_from_pdf(res.content)
-                df.at[idx, "バリューG"] = extracted
-                update_count += 1
-                logging.info(f"🖼️ 抽出(G): {url} → {extracted}")
+def work_バリューG(url, val_t):
+    if skip_image_stage(url, val_t, 10, value_confident):
+        return SKIPPED
+    page_numbers = _value_page_numbers(url)
+    return download_and_extract(
+        url, lambda pdf_path: extract_value_from_pdf(pdf_path, page_numbers), "🖼️ 抽出(G)"
+    )
 
-            else:
-                df.at[idx, "バリューG"] = "取得失敗"
-                update_count += 1
-                logging.warning(f"⚠️ DL失敗 {res.status_code}: {url}")
 
-        except Exception as e:
-            df.at[idx, "バリューG"] = "取得失敗"
-            update_count += 1
-            logging.warning(f"❌ 例外発生 {e}: {url}")
+def update_バリューG(worksheet, df=None):
+    logging.info("🖼️ update_バリューG 開始")
 
-    df.replace([np.nan, np.inf, -np.inf], '', inplace=True)
+    standalone = df is None
+    if standalone:
+        df = load_sheet_df(worksheet, COLUMNS_バリューG)
+        before = df.copy()
 
-    # Excel列名計算
-    def col_to_letter(index):
-        letters = ""
-        while index >= 0:
-            index, rem = divmod(index, 26)
-            letters = chr(65 + rem) + letters
-            index -= 1
-        return letters
+    if 'バリューG' not in df.columns:
+        df['バリューG'] = ''
 
-    col_index = df.columns.get_loc("バリューG")
-    col_letter = col_to_letter(col_index)
+    update_count = 0
+    tasks = []
 
-    worksheet.update(
-        f"{col_letter}2:{col_letter}{len(df)+1}",
-        [[v] for v in df["バリューG"].tolist()]
-    )
+    for idx, row in df.iterrows():
+        value, args = plan_バリューG(row)
+        if value is not None:
+            df.at[idx, "バリューG"] = value
+            update_count += 1
+            row_done()
+        elif args is not None:
+            tasks.append((idx, args))
+
+    tasks, members = group_tasks(tasks, pdf_key, "update_バリューG")
+    for idx, extracted in run_rows(work_バリューG, tasks, key=cached_first):
+        for member in members[idx]:
+            df.at[member, "バリューG"] = extracted
+            update_count += 1
+            row_done()
+
+    if standalone:
+        write_changes(worksheet, before, df, ["バリューG"])
 
     logging.info(f"📝 {update_count} 件のバリューGを更新")
     return f"{update_count} 件更新", 200
@@ -240,16 +227,12 @@ def update_バリューG(worksheet):
 #  3) バリュー統合（T + G → バリュー）
 # ============================================================
 
-merge_model = None
-
 def merge_values(value_t, value_g):
     """バリューT と バリューG を統合して最終バリューを返す"""
-    global merge_model
-    if merge_model is None:
-        merge_model = init_gemini()
+    model = get_model()
 
     def is_valid(val):
-        return val and val not in ["取得失敗", "対象外"]
+        return val and val not in ["取得失敗", "対象外", SKIPPED]
 
     # 片方だけ有効 → そのまま採用
     if is_valid(value_t) and not is_valid(value_g):
@@ -273,8 +256,7 @@ def merge_values(value_t, value_g):
 ・うまく統合できない場合「取得失敗」と返す
 ・統合後の文字数の合計が100文字未満の場合は「取得失敗」と返す
 """
-            response = merge_model.generate_content(prompt)
-            result = response.text.strip()
+            result = generate_text(model, prompt, "value_merge/v1").strip()
 
             if not result or len(result) < 70:
                 return "取得失敗"
@@ -288,59 +270,60 @@ def merge_values(value_t, value_g):
     return "取得失敗"
 
 
+def plan_バリュー(row):
+    val_final = row.get("バリュー", "")
+    company = row.get("会社名", "")
+    url = row.get("URL", "")
+
+    # 既に値が入っていればスキップ
+    if val_final:
+        return None, None
+
+    # 対象外ならそのまま
+    if company == "対象外":
+        logging.info(f"⏭️ 対象外（会社名）: {url}")
+        return "対象外", None
+
+    return None, (row.get("バリューT", ""), row.get("バリューG", ""))
+
+
+work_バリュー = merge_values
+
+
 # ------------------------------------------------------------
 # update_バリュー
 # ------------------------------------------------------------
-def update_バリュー(worksheet):
+def update_バリュー(worksheet, df=None):
     logging.info("🔄 update_バリュー 開始")
 
-    df = get_as_dataframe(worksheet)
-    df.fillna("", inplace=True)
+    standalone = df is None
+    if standalone:
+        df = load_sheet_df(worksheet, COLUMNS_バリュー)
+        before = df.copy()
 
     if "バリュー" not in df.columns:
         df["バリュー"] = ""
 
     update_count = 0
+    tasks = []
 
     for idx, row in df.iterrows():
-        val_final = row.get("バリュー", "")
-        company = row.get("会社名", "")
-        url = row.get("URL", "")
-
-        # 既に値が入っていればスキップ
-        if val_final:
-            continue
-
-        # 対象外ならそのまま
-        if company == "対象外":
-            df.at[idx, "バリュー"] = "対象外"
+        value, args = plan_バリュー(row)
+        if value is not None:
+            df.at[idx, "バリュー"] = value
             update_count += 1
-            logging.info(f"⏭️ 対象外（会社名）: {url}")
-            continue
+            row_done()
+        elif args is not None:
+            tasks.append((idx, args))
 
-        merged = merge_values(row.get("バリューT", ""), row.get("バリューG", ""))
+    for idx, merged in run_rows(work_バリュー, tasks):
         df.at[idx, "バリュー"] = merged
         update_count += 1
-        logging.info(f"📝 統合: {url} → {merged[:30]}...")
-
-    df.replace([np.nan, np.inf, -np.inf], "", inplace=True)
+        row_done()
+        logging.info(f"📝 統合: {df.at[idx, 'URL']} → {merged[:30]}...")
 
-    # Excel列名計算（既存方式）
-    def col_to_letter(index):
-        letters = ""
-        while index >= 0:
-            index, rem = divmod(index, 26)
-            letters = chr(65 + rem) + letters
-            index -= 1
-        return letters
-
-    col_index = df.columns.get_loc("バリュー")
-    col_letter = col_to_letter(col_index)
-
-    worksheet.update(
-        f"{col_letter}2:{col_letter}{len(df)+1}",
-        [[v] for v in df["バリュー"].tolist()],
-    )
+    if standalone:
+        write_changes(worksheet, before, df, ["バリュー"])
 
     logging.info(f"📝 {update_count} 件のバリューを更新しました")
     return f"{update_count} 件更新", 200
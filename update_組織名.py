@@ -1,48 +1,39 @@
 import logging
-import requests
-import numpy as np
-from io import BytesIO
-from pypdf import PdfReader
-from pdf2image import convert_from_bytes
 import warnings
-from gspread_dataframe import get_as_dataframe
-import google.generativeai as genai
-import os
-import gc
+
+from pdf_cache import cached_first
+from pdf_text import download_and_extract
+from pdf_render import render_pages
+from sheet_io import load_sheet_df, write_changes
+from executor import run_rows
+from run_budget import row_done
+from llm_cache import generate_text
+from gemini_client import get_model
+from llm_batch import ask_batch, run_batched
+from company_index import lookup_security_code
+from cascade import SKIPPED, skip_image_stage, company_name_confident
+from dedup import group_tasks, pdf_key, company_key
 
 
 # -------------------------------
-# Gemini 初期化（1回のみ）
+# 各ステージがシートから読む列（単独実行時はこの列だけを読む）
 # -------------------------------
-def init_gemini():
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("環境変数 GEMINI_API_KEY が設定されていません")
-    genai.configure(api_key=api_key)
-    return genai.GenerativeModel("gemini-2.5-flash")
-
-
-text_model = None
-image_model = None
+# URL だけが入った行も「対象外」などの判定対象になるので、どのステージも URL を含める。
+COLUMNS_組織名T = ["URL", "ページ数", "会社名T"]
+COLUMNS_組織名G = ["URL", "ページ数", "会社名T", "会社名G"]
+COLUMNS_組織名 = ["URL", "会社名T", "会社名G", "会社名"]
+COLUMNS_証券番号 = ["URL", "会社名", "証券番号"]
+SHEET_COLUMNS = list(dict.fromkeys(COLUMNS_組織名T + COLUMNS_組織名G + COLUMNS_組織名 + COLUMNS_証券番号))
 
 
 # ============================================================
 #  1) テキストで抽出（組織名T）
 # ============================================================
-def extract_company_name_from_text(pdf_bytes):
-    global text_model
-    if text_model is None:
-        text_model = init_gemini()
+def extract_company_name_from_text(page_texts):
+    model = get_model()
 
-    reader = None
     try:
-        reader = PdfReader(BytesIO(pdf_bytes))
-        all_text = ""
-
-        for i in range(min(3, len(reader.pages))):
-            text = reader.pages[i].extract_text()
-            if text:
-                all_text += text + "\n"
+        all_text = "".join(text + "\n" for text in page_texts if text)
 
         if not all_text.strip():
             return "取得失敗"
@@ -58,70 +49,69 @@ def extract_company_name_from_text(pdf_bytes):
         - 取得に失敗した場合は「取得失敗」
         """
 
-        response = text_model.generate_content([prompt, all_text])
-        result = response.text.strip()
+        result = generate_text(model, [prompt, all_text], "company_name_text/v1").strip()
         return result if result else "取得失敗"
 
     except Exception as e:
         logging.warning(f"Geminiテキスト処理失敗: {e}")
         return "取得失敗"
 
-    finally:
-        # ---- メモリ解放 ----
-        del reader
-        del pdf_bytes
-        gc.collect()
 
+# -------------------------------
+# 行ごとの判定と処理（ステージ一括処理と行単位スケジューラで共通）
+# -------------------------------
+# plan_xxx(row) は (すぐ書く値, work_xxx に渡す引数) を返す。
+# 何もしない行は (None, None)、値が決まっている行は (値, None)、
+# 処理が必要な行は (None, 引数タプル)。
+def plan_組織名T(row):
+    url = row['URL']
+    name_t = row.get('会社名T', '')
+    page_count = row['ページ数']
+
+    if not url or name_t:
+        return None, None
+
+    # ページ数制限
+    if isinstance(page_count, (int, float)) and page_count <= 15:
+        logging.info(f"⏭️ 対象外: {url}")
+        return '対象外', None
+
+    return None, (url,)
+
+
+def work_組織名T(url):
+    return download_and_extract(url, extract_company_name_from_text, "🔍 T抽出", pages=3, timeout=15)
 
-def update_組織名T(worksheet):
+
+def update_組織名T(worksheet, df=None):
     logging.info("🏢 update_組織名T開始")
 
-    df = get_as_dataframe(worksheet)
-    df.fillna('', inplace=True)
+    standalone = df is None
+    if standalone:
+        df = load_sheet_df(worksheet, COLUMNS_組織名T)
+        before = df.copy()
 
     update_count = 0
+    tasks = []
 
     for idx, row in df.iterrows():
-        url = row['URL']
-        name_t = row.get('会社名T', '')
-        page_count = row['ページ数']
-
-        if not url or name_t:
-            continue
-
-        # ページ数制限
-        if isinstance(page_count, (int, float)) and page_count <= 15:
-            df.at[idx, '会社名T'] = '対象外'
+        value, args = plan_組織名T(row)
+        if value is not None:
+            df.at[idx, '会社名T'] = value
             update_count += 1
-            logging.info(f"⏭️ 対象外: {url}")
-            continue
-
-        try:
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            res = requests.get(url, headers=headers, timeout=15)
-
-            if res.status_code == 200:
-                extracted = extract_company_name_from_text(res.content)
-                df.at[idx, '会社名T'] = extracted
-                logging.info(f"🔍 T抽出: {url} → {extracted}")
-            else:
-                df.at[idx, '会社名T'] = '取得失敗'
-                logging.warning(f"⚠️ DL失敗 {url}")
-        except Exception as e:
-            df.at[idx, '会社名T'] = '取得失敗'
-            logging.warning(f"❌ error: {e} {url}")
-
-        update_count += 1
-
-    # シート更新
-    df.replace([np.nan, np.inf, -np.inf], '', inplace=True)
-    col_index = df.columns.get_loc('会社名T')
-    col_letter = chr(ord('A') + col_index)
-
-    worksheet.update(
-        f"{col_letter}2:{col_letter}{len(df)+1}",
-        [[v] for v in df['会社名T'].tolist()]
-    )
+            row_done()
+        elif args is not None:
+            tasks.append((idx, args))
+
+    tasks, members = group_tasks(tasks, pdf_key, "update_組織名T")
+    for idx, extracted in run_rows(work_組織名T, tasks, key=cached_first):
+        for member in members[idx]:
+            df.at[member, '会社名T'] = extracted
+            update_count += 1
+            row_done()
+
+    if standalone:
+        write_changes(worksheet, before, df, ['会社名T'])
     logging.info(f"📄 {update_count} 件の会社名T更新")
 
     return f"{update_count} 件更新", 200
@@ -130,14 +120,11 @@ def update_組織名T(worksheet):
 # ============================================================
 #  2) 画像で抽出（組織名G）
 # ============================================================
-def extract_company_name_from_pdf_image(pdf_bytes):
-    global image_model
-    if image_model is None:
-        image_model = init_gemini()
+def extract_company_name_from_pdf_image(pdf_path):
+    model = get_model()
 
-    images = None
     try:
-        images = convert_from_bytes(pdf_bytes, dpi=150, first_page=1, last_page=3)
+        images = render_pages(pdf_path, 3)
 
         prompt = """
         これは統合報告書の最初の数ページの画像です。
@@ -150,76 +137,64 @@ def extract_company_name_from_pdf_image(pdf_bytes):
         - 判別できない場合は「取得失敗」
         """
 
-        response = image_model.generate_content([prompt, *images])
-        result = response.text.strip()
+        result = generate_text(model, [prompt, *images], "company_name_image/v1").strip()
         return result if result else "取得失敗"
 
     except Exception as e:
         warnings.warn(f"Gemini画像処理失敗: {e}")
         return "取得失敗"
 
-    finally:
-        # ---- 画像メモリ解放 ----
-        if images:
-            for img in images:
-                try:
-                    img.close()
-                except:
-                    pass
-            del images
 
-        del pdf_bytes
-        gc.collect()
+def plan_組織名G(row):
+    url = row['URL']
+    name_g = row.get('会社名G', '')
+    page_count = row['ページ数']
+
+    if not url or name_g:
+        return None, None
+
+    if isinstance(page_count, (int, float)) and page_count <= 15:
+        logging.info(f"⏭️ 対象外: {url}")
+        return '対象外', None
+
+    return None, (url, row.get('会社名T', ''))
+
 
+def work_組織名G(url, name_t):
+    if skip_image_stage(url, name_t, 3, company_name_confident):
+        return SKIPPED
+    return download_and_extract(url, extract_company_name_from_pdf_image, "🖼️ G抽出", timeout=15)
 
-def update_組織名G(worksheet):
+
+def update_組織名G(worksheet, df=None):
     logging.info("🏢 update_組織名G開始")
 
-    df = get_as_dataframe(worksheet)
-    df.fillna('', inplace=True)
+    standalone = df is None
+    if standalone:
+        df = load_sheet_df(worksheet, COLUMNS_組織名G)
+        before = df.copy()
 
     update_count = 0
+    tasks = []
 
     for idx, row in df.iterrows():
-        url = row['URL']
-        name_g = row.get('会社名G', '')
-        page_count = row['ページ数']
-
-        if not url or name_g:
-            continue
-
-        if isinstance(page_count, (int, float)) and page_count <= 15:
-            df.at[idx, '会社名G'] = '対象外'
+        value, args = plan_組織名G(row)
+        if value is not None:
+            df.at[idx, '会社名G'] = value
             update_count += 1
-            logging.info(f"⏭️ 対象外: {url}")
-            continue
-
-        try:
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            res = requests.get(url, headers=headers, timeout=15)
-
-            if res.status_code == 200:
-                extracted = extract_company_name_from_pdf_image(res.content)
-                df.at[idx, '会社名G'] = extracted
-                logging.info(f"🖼️ G抽出: {url} → {extracted}")
-            else:
-                df.at[idx, '会社名G'] = '取得失敗'
-                logging.warning(f"⚠️ DL失敗 {url}")
-        except Exception as e:
-            df.at[idx, '会社名G'] = '取得失敗'
-            logging.warning(f"❌ error: {e} {url}")
-
-        update_count += 1
-
-    # シート更新
-    df.replace([np.nan, np.inf, -np.inf], '', inplace=True)
-    col_index = df.columns.get_loc('会社名G')
-    col_letter = chr(ord('A') + col_index)
-
-    worksheet.update(
-        f"{col_letter}2:{col_letter}{len(df)+1}",
-        [[v] for v in df['会社名G'].tolist()]
-    )
+            row_done()
+        elif args is not None:
+            tasks.append((idx, args))
+
+    tasks, members = group_tasks(tasks, pdf_key, "update_組織名G")
+    for idx, extracted in run_rows(work_組織名G, tasks, key=cached_first):
+        for member in members[idx]:
+            df.at[member, '会社名G'] = extracted
+            update_count += 1
+            row_done()
+
+    if standalone:
+        write_changes(worksheet, before, df, ['会社名G'])
 
     logging.info(f"📄 {update_count} 件の会社名G更新")
     return f"{update_count} 件更新", 200
@@ -228,124 +203,134 @@ def update_組織名G(worksheet):
 # ============================================================
 #  3) T/G統合 → 会社名
 # ============================================================
-def update_組織名(worksheet):
-    logging.info("🏢 update_組織名（T/G統合処理）開始")
+def _judge_company_name(name_t, name_g):
+    """両方有効な候補から Gemini に正式名を選ばせる。判定できなければ None"""
+    try:
+        prompt = f"""
+            次の2つの会社名候補のうち、
+            より正式な会社名として適切なものを選んでください。
 
-    global text_model
-    if text_model is None:
-        text_model = init_gemini()
+            - {name_t}
+            - {name_g}
 
-    df = get_as_dataframe(worksheet)
-    df.fillna('', inplace=True)
+            条件:
+            - 選んだ名前のみ1行で返す
+            """
 
-    # 「会社名」列がなければ作成
-    if '会社名' not in df.columns:
-        df['会社名'] = ''
+        best_name = generate_text(get_model(), prompt, "company_name_judge/v1").strip()
 
-    update_count = 0
+        if best_name in [name_t, name_g]:
+            logging.info(f"🧠 Gemini判断: {best_name}")
+            return best_name
 
-    def is_invalid(name):
-        return name in ['', '取得失敗', '対象外']
+        logging.warning(f"⚠️ 判定不能: {best_name}")
+        return None
 
-    for idx, row in df.iterrows():
-        name_t = row.get('会社名T', '').strip()
-        name_g = row.get('会社名G', '').strip()
-        current = row.get('会社名', '').strip()
+    except Exception as e:
+        logging.warning(f"Gemini判断失敗: {e}")
+        return None
 
-        if current:
-            continue
 
-        if is_invalid(name_t) and is_invalid(name_g):
-            df.at[idx, '会社名'] = '対象外'
-            update_count += 1
-            logging.info("⏭️ 対象外（両方無効）")
-            continue
+def _is_invalid_name(name):
+    return name in ['', '取得失敗', '対象外', SKIPPED]
 
-        if not is_invalid(name_t) and is_invalid(name_g):
-            df.at[idx, '会社名'] = name_t
-            update_count += 1
-            logging.info(f"✅ 単独採用（T）: {name_t}")
-            continue
 
-        if not is_invalid(name_g) and is_invalid(name_t):
-            df.at[idx, '会社名'] = name_g
-            update_count += 1
-            logging.info(f"✅ 単独採用（G）: {name_g}")
-            continue
+def plan_組織名(row):
+    name_t = row.get('会社名T', '').strip()
+    name_g = row.get('会社名G', '').strip()
+    current = row.get('会社名', '').strip()
 
-        # 両方有効 → Gemini 判定
-        try:
-            prompt = f"""
-            次の2つの会社名候補のうち、
-            より正式な会社名として適切なものを選んでください。
+    if current:
+        return None, None
 
-            - {name_t}
-            - {name_g}
+    if _is_invalid_name(name_t) and _is_invalid_name(name_g):
+        logging.info("⏭️ 対象外（両方無効）")
+        return '対象外', None
 
-            条件:
-            - 選んだ名前のみ1行で返す
-            """
+    if not _is_invalid_name(name_t) and _is_invalid_name(name_g):
+        logging.info(f"✅ 単独採用（T）: {name_t}")
+        return name_t, None
 
-            response = text_model.generate_content(prompt)
-            best_name = response.text.strip()
+    if not _is_invalid_name(name_g) and _is_invalid_name(name_t):
+        logging.info(f"✅ 単独採用（G）: {name_g}")
+        return name_g, None
 
-            if best_name in [name_t, name_g]:
-                df.at[idx, '会社名'] = best_name
-                update_count += 1
-                logging.info(f"🧠 Gemini判断: {best_name}")
-            else:
-                logging.warning(f"⚠️ 判定不能: {best_name}")
+    # 両方有効 → Gemini 判定（複数行まとめて実行）
+    return None, ({"candidates": [name_t, name_g]},)
 
-        except Exception as e:
-            logging.warning(f"Gemini判断失敗: {e}")
 
-    # シート更新
-    df.replace([np.nan, np.inf, -np.inf], '', inplace=True)
-    col_index = df.columns.get_loc('会社名')
-    col_letter = chr(ord('A') + col_index)
+JUDGE_INSTRUCTION = """
+    以下の JSON の各行について、candidates の2つの会社名候補のうち、
+    より正式な会社名として適切なものを選んでください。
 
-    worksheet.update(
-        f"{col_letter}2:{col_letter}{len(df)+1}",
-        [[v] for v in df['会社名'].tolist()]
-    )
+    条件:
+    - 回答は選んだ名前のみ（candidates の表記そのまま）
+    """
 
-    logging.info(f"📄 {update_count} 件の会社名を更新")
-    return f"{update_count} 件更新", 200
 
+def _judge_valid(item, answer):
+    return answer in item["candidates"]
 
-# ============================================================
-#  4) 証券番号推定
-# ============================================================
-def update_証券番号(worksheet):
-    logging.info("💹 update_証券番号開始")
 
-    global text_model
-    if text_model is None:
-        text_model = init_gemini()
+def _judge_fallback(item):
+    return _judge_company_name(*item["candidates"])
 
-    df = get_as_dataframe(worksheet)
-    df.fillna('', inplace=True)
 
-    if '証券番号' not in df.columns:
-        df['証券番号'] = ''
+def work_組織名(chunk):
+    """複数行 [(idx, 入力), ...] をまとめて判定し [(idx, 会社名), ...] を返す。判定できなければ None"""
+    return ask_batch(get_model(), JUDGE_INSTRUCTION, chunk, _judge_valid, _judge_fallback)
+
+
+def update_組織名(worksheet, df=None):
+    logging.info("🏢 update_組織名（T/G統合処理）開始")
+
+    standalone = df is None
+    if standalone:
+        df = load_sheet_df(worksheet, COLUMNS_組織名)
+        before = df.copy()
+
+    # 「会社名」列がなければ作成
+    if '会社名' not in df.columns:
+        df['会社名'] = ''
 
     update_count = 0
+    tasks = []
 
     for idx, row in df.iterrows():
-        company = row.get("会社名", "").strip()
-        current_code = row.get("証券番号", "").strip()
-
-        if current_code:
-            continue
+        value, args = plan_組織名(row)
+        if value is not None:
+            df.at[idx, '会社名'] = value
+            update_count += 1
+            row_done()
+        elif args is not None:
+            tasks.append((idx, args[0]))
+
+    results = run_batched(
+        get_model(), JUDGE_INSTRUCTION, tasks,
+        validate=_judge_valid,
+        fallback=_judge_fallback,
+    )
 
-        if company in ["対象外", "取得失敗", ""]:
-            df.at[idx, "証券番号"] = "対象外"
+    for idx, best_name in results:
+        if best_name:
+            df.at[idx, '会社名'] = best_name
             update_count += 1
-            logging.info(f"⏭️ 対象外扱い: {company}")
-            continue
+            row_done()
+
+    if standalone:
+        write_changes(worksheet, before, df, ['会社名'])
+
+    logging.info(f"📄 {update_count} 件の会社名を更新")
+    return f"{update_count} 件更新", 200
 
-        try:
-            prompt = f"""
+
+# ============================================================
+#  4) 証券番号推定
+# ============================================================
+def _guess_security_code(company):
+    """会社名から 4 桁の証券コードを推定する。推定できなければ「対象外」"""
+    try:
+        prompt = f"""
             以下の会社名から日本の証券コード（4桁）を推定してください。
 
             条件:
@@ -356,41 +341,102 @@ def update_証券番号(worksheet):
             会社名: {company}
             """
 
-            response = text_model.generate_content(prompt)
-            code = response.text.strip()
+        code = generate_text(get_model(), prompt, "security_code/v1").strip()
 
-            if code.isdigit() and len(code) == 4:
-                df.at[idx, "証券番号"] = code
-                update_count += 1
-                logging.info(f"✅ {company} → {code}")
-            else:
-                df.at[idx, "証券番号"] = "対象外"
-                update_count += 1
-                logging.info(f"⚠️ 不明 → 対象外: {company} → {code}")
+        if code.isdigit() and len(code) == 4:
+            logging.info(f"✅ {company} → {code}")
+            return code
 
-        except Exception as e:
-            df.at[idx, "証券番号"] = "対象外"
-            update_count += 1
-            logging.warning(f"❌ エラー → 対象外扱い: {e}")
+        logging.info(f"⚠️ 不明 → 対象外: {company} → {code}")
+        return "対象外"
 
-    # シート更新
-    df.replace([np.nan, np.inf, -np.inf], '', inplace=True)
+    except Exception as e:
+        logging.warning(f"❌ エラー → 対象外扱い: {e}")
+        return "対象外"
 
-    def column_index_to_letter(index):
-        letters = ""
-        while index >= 0:
-            index, remainder = divmod(index, 26)
-            letters = chr(65 + remainder) + letters
-            index -= 1
-        return letters
 
-    col_index = df.columns.get_loc("証券番号")
-    col_letter = column_index_to_letter(col_index)
+def plan_証券番号(row):
+    company = row.get("会社名", "").strip()
+    current_code = row.get("証券番号", "").strip()
 
-    worksheet.update(
-        f"{col_letter}2:{col_letter}{len(df)+1}",
-        [[v] for v in df["証券番号"].tolist()]
+    if current_code:
+        return None, None
+
+    if company in ["対象外", "取得失敗", ""]:
+        logging.info(f"⏭️ 対象外扱い: {company}")
+        return "対象外", None
+
+    # 上場企業一覧で確実に引ければ Gemini は使わない
+    code = lookup_security_code(company)
+    if code:
+        logging.info(f"📇 一覧照合: {company} → {code}")
+        return code, None
+
+    return None, ({"company": company},)
+
+
+SECURITY_CODE_INSTRUCTION = """
+    以下の JSON の各行について、company の会社名から日本の証券コード（4桁）を推定してください。
+
+    条件:
+    - 回答は4桁のみ
+    - 存在しない場合は「対象外」
+    - 補足説明禁止
+    """
+
+
+def _security_code_valid(item, answer):
+    return answer == "対象外" or (answer.isdigit() and len(answer) == 4)
+
+
+def _security_code_fallback(item):
+    return _guess_security_code(item["company"])
+
+
+def work_証券番号(chunk):
+    """複数行 [(idx, 入力), ...] をまとめて推定し [(idx, 証券番号), ...] を返す"""
+    return ask_batch(get_model(), SECURITY_CODE_INSTRUCTION, chunk, _security_code_valid, _security_code_fallback)
+
+
+def update_証券番号(worksheet, df=None):
+    logging.info("💹 update_証券番号開始")
+
+    standalone = df is None
+    if standalone:
+        df = load_sheet_df(worksheet, COLUMNS_証券番号)
+        before = df.copy()
+
+    if '証券番号' not in df.columns:
+        df['証券番号'] = ''
+
+    update_count = 0
+    tasks = []
+
+    for idx, row in df.iterrows():
+        value, args = plan_証券番号(row)
+        if value is not None:
+            df.at[idx, "証券番号"] = value
+            update_count += 1
+            row_done()
+        elif args is not None:
+            tasks.append((idx, args[0]))
+
+    # 同じ会社の行（年度違いなど）は 1 回だけ推定する
+    tasks, members = group_tasks(tasks, company_key, "update_証券番号")
+    results = run_batched(
+        get_model(), SECURITY_CODE_INSTRUCTION, tasks,
+        validate=_security_code_valid,
+        fallback=_security_code_fallback,
     )
 
+    for idx, code in results:
+        for member in members[idx]:
+            df.at[member, "証券番号"] = code
+            update_count += 1
+            row_done()
+
+    if standalone:
+        write_changes(worksheet, before, df, ["証券番号"])
+
     logging.info(f"📄 {update_count} 件の証券番号を更新")
     return f"{update_count} 件更新", 200